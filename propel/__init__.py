@@ -17,45 +17,141 @@ $$ |      $$ |      \$$$$$$  |$$$$$$$  |\$$$$$$$\ $$ |
 
 
 import argparse
+import contextlib
 import datetime
+import difflib
+import fcntl
+import filecmp
 import getpass
+import grp
+import gzip
+import hashlib
+import json
 import multiprocessing
+import multiprocessing.pool
 import os
 import platform
-import random
+import pwd
+import re
 import shutil
+import signal
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 from __about__ import *
 
+try:
+    import httplib
+    import xmlrpclib
+except ImportError:  # Python 3
+    import http.client as httplib
+    import xmlrpc.client as xmlrpclib
+
 try:
     import yaml
 except ImportError as ex:
     print("PyYaml is missing. pip install pyyaml")
 try:
-    from jinja2 import Template
+    from jinja2 import Environment, ChoiceLoader, DictLoader, FileSystemLoader, \
+        FileSystemBytecodeCache
 except ImportError as ex:
     print("Jinja2 is missing. pip install jinja2")
+try:
+    import brotli  # Optional, to precompress static files to .br
+except ImportError:
+    brotli = None
 
 
 PY_EXECUTABLE = sys.executable
 PY_USER = getpass.getuser()
 CWD = os.getcwd()
+# Keep the path as the shell sees it, so the `current` release symlink is not resolved
+if os.environ.get("PWD") and os.path.isdir(os.environ["PWD"]) \
+        and os.path.samefile(os.environ["PWD"], CWD):
+    CWD = os.environ["PWD"]
 
+NGINX_BIN = "nginx"
+NGINX_MAIN_CONF = "/etc/nginx/nginx.conf"
 NGINX_DEFAULT_PORT = 80
+NGINX_UPSTREAM_KEEPALIVE = 32  # Idle connections to gunicorn kept open per nginx worker
+NGINX_STATIC_DEFAULTS = {  # Defaults of `nginx.static`, applied to the aliases
+    "expires": "30d",  # Sets Expires and Cache-Control max-age
+    "gzip_static": True,
+    "brotli_static": False,  # Requires the ngx_brotli module
+    "open_file_cache": "max=1000 inactive=60s",
+    "sendfile": True,
+    "precompress": False
+}
+LOGROTATE_CONF_FILE = "/etc/logrotate.d/propel-%s"  # Rotation of the nginx logs of an app
+LOGROTATE_DEFAULTS = {  # Defaults of the `logs` section of propel.yml
+    "frequency": "daily",
+    "rotate": 14,
+    "maxsize": "100M",
+    "compress": True
+}
+NGINX_CACHE_DIRECTORY = "/var/cache/nginx/propel"  # proxy_cache_path of the sites with `nginx.cache`
+NGINX_CACHE_DEFAULTS = {  # Defaults of `nginx.cache`, microcaching of the Python sites
+    "zone_size": "10m",
+    "max_size": "1g",
+    "inactive": "10m",
+    "valid": {"200 301 302": "1s"},
+    "bypass_cookies": None,  # None bypasses the cache on any cookie
+    "use_stale": "updating error timeout http_500 http_502 http_503 http_504",
+    "lock": True
+}
+STATIC_PRECOMPRESS_EXTENSIONS = [".css", ".js", ".html", ".htm", ".svg", ".json", ".xml",
+                                 ".txt", ".map", ".ico", ".ttf", ".otf", ".eot"]
+STATIC_PRECOMPRESS_MIN_SIZE = 256  # Bytes. Smaller files are not worth compressing
 GUNICORN_PORT_RANGE = [8000, 9000]  # Port range for gunicorn proxy
+GUNICORN_PORTS_REGISTRY = "/var/propel/ports.json"  # Ports assigned to each gunicorn program
+GUNICORN_SOCKET_DIR = "/run/propel"  # Unix sockets of the sites with `bind: unix`, by user
+TMPFILES_CONF = "/etc/tmpfiles.d/propel.conf"  # Recreates GUNICORN_SOCKET_DIR on boot
 GUNICORN_DEFAULT_THREADS = 4
 GUNICORN_DEFAULT_MAX_REQUESTS = 500
 GUNICORN_DEFAULT_WORKER_CLASS = "gevent"
+GUNICORN_MAX_THREADS = 32  # Threads per worker when autotune trades workers for threads
+GUNICORN_WORKER_MEMORY = "150M"  # Memory of a worker for autotune, when it can't be measured
+AUTOTUNE_MEMORY_RESERVE = 0.25  # Part of the memory autotune leaves to the system and workers
+GUNICORN_BOOT_TIMEOUT = 60  # Seconds to wait for a new gunicorn to answer
+GUNICORN_DRAIN_TIME = 10  # Seconds to let the previous gunicorn finish requests
+HEALTHCHECK_DEFAULTS = {  # Defaults of the `healthcheck` of a site
+    "path": "/",
+    "status": 200,  # Expected status, or a list of them
+    "timeout": 5,  # Seconds per probe
+    "retries": 30,  # Probes of a backend before giving up
+    "interval": 1,  # Seconds between the probes of a backend
+    "concurrency": 4,  # Backends probed at once
+    "host": None  # Host header, the first server_name by default
+}
+
+DEPLOY_JOBS = 4  # Deploy steps, sites and programs run concurrently. Override with --jobs
+DEPLOY_STEP_TIMEOUT = None  # Seconds a deploy step may run. Override with --timeout
 
 VIRTUALENV = None
 VERBOSE = False
+DRY_RUN = False  # Print the diff of the configs instead of writing them, with --dry-run
 VIRTUALENV_DIRECTORY = "/root/.virtualenvs"
-VIRTUALENV_DEFAULT_PACKAGES = ["gunicorn", "gevent"]
+VIRTUALENV_DEFAULT_PACKAGES = ["gunicorn", "gevent", "wheel"]
+# Fingerprint of the last requirements install, kept in the virtualenv
+VIRTUALENV_REQUIREMENTS_FINGERPRINT = ".propel-requirements"
+# Shared wheels of all the apps, built with `pip wheel`
+WHEELHOUSE_DIRECTORY = "/var/propel/wheels"
+VIRTUALENV_KEEP_GENERATIONS = 2  # Rebuilt virtualenvs to keep, including the live one
 LOCAL_BIN = "/usr/local/bin"
 
+TEMPLATES_DIRECTORY = "/var/propel/templates"  # Overrides of the templates below, by name
+TEMPLATES_CACHE_DIRECTORY = "/var/propel/templates-cache"  # Compiled templates. None to disable
+
+GIT_DEFAULT_BRANCH = "master"  # Branch deployed on git push. Override with --git-branch
+RELEASES_DIRECTORY = "releases"  # With --releases, each push is checked out in <repo>/releases/<commit>
+RELEASES_CURRENT = "current"  # Symlink to the live release, in <repo>
+RELEASES_KEEP = 5  # Releases to keep, besides the live one
+RELEASES_ORDER_FILE = ".order"  # In <repo>/releases, the releases from the oldest to the newest
+
 DEPLOY_CONFIG_FILE = "propel.yml"
 DEPLOY_CONFIG = None
 
@@ -63,6 +159,7 @@ DEPLOY_CONFIG = None
 DIST_CONF = {
     "RHEL": {
         "NGINX_CONF_FILE": "/etc/nginx/conf.d/%s.conf",
+        "NGINX_GROUP": "nginx",
         "APT_GET": "yum",
         "INSTALL_PROGRAMS": ["nginx", 'groupinstall "Development Tools"', "python-devel", "php-fpm", "supervisor"],
         "RELOAD_PROGRAMS": ["nginx", "php-fpm"],
@@ -71,6 +168,7 @@ DIST_CONF = {
     },
     "DEBIAN": {
         "NGINX_CONF_FILE": "/etc/nginx/sites-enabled/%s.conf",
+        "NGINX_GROUP": "www-data",
         "APT_GET": "apt-get",
         "INSTALL_PROGRAMS": ["nginx", 'python-dev', "php5-fpm", "supervisor"],
         "RELOAD_PROGRAMS": ["nginx", "php5-fpm"],
@@ -83,6 +181,8 @@ DIST_CONF = {
 
 # SUPERVISOR
 SUPERVISOR_CTL = "supervisorctl"
+# supervisord unix sockets for XML-RPC. supervisorctl is used when none answers
+SUPERVISOR_SOCKETS = ["/tmp/supervisor.sock", "/var/run/supervisor.sock"]
 SUPERVISOR_LOG_DIR = "/var/log/supervisor"
 SUPERVISOR_CONF_DIR = "/etc/supervisor/conf.d"
 SUPERVISOR_TPL = """
@@ -90,14 +190,41 @@ SUPERVISOR_TPL = """
 command={command}
 directory={directory}
 user={user}
-autostart=true
-autorestart=true
-stopwaitsecs=600
-startsecs=10
 stdout_logfile={log}
-stderr_logfile={log}
 environment={environment}
-"""
+{options}"""
+SUPERVISOR_DEFAULT_OPTIONS = {
+    "autostart": True,
+    "autorestart": True,
+    "stopwaitsecs": 600,
+    "startsecs": 10,
+    # stdout and stderr share the log file, supervisor rotates it
+    "redirect_stderr": True
+}
+# Options of the `supervisor` section of a web or worker, with their type.
+# `nice` and `minfds` are applied to the command, with nice and prlimit
+SUPERVISOR_OPTIONS = {
+    "numprocs": "int",
+    "priority": "int",
+    "autostart": "bool",
+    "autorestart": "autorestart",
+    "startsecs": "int",
+    "startretries": "int",
+    "stopsignal": "signal",
+    "stopwaitsecs": "int",
+    "stopasgroup": "bool",
+    "killasgroup": "bool",
+    "exitcodes": "string",
+    "umask": "string",
+    "redirect_stderr": "bool",
+    "stdout_logfile_maxbytes": "size",
+    "stdout_logfile_backups": "int",
+    "stderr_logfile_maxbytes": "size",
+    "stderr_logfile_backups": "int",
+    "nice": "nice",
+    "minfds": "int"
+}
+SUPERVISOR_SIGNALS = ["TERM", "HUP", "INT", "QUIT", "KILL", "USR1", "USR2"]
 
 NGINX_CONFIG = """
 {%- macro SET_PATH(directory, path="") %}
@@ -109,16 +236,45 @@ NGINX_CONFIG = """
 {% endmacro -%}
 
 
+{% if LOGS_DIR and ACCESS_LOG and ACCESS_LOG.sample %}
+split_clients "${remote_addr}${msec}" ${{ ACCESS_LOG.var }} {
+    {{ ACCESS_LOG.sample }}% 1;
+    * 0;
+}
+{% endif %}
+
+{% if BACKENDS and CACHE %}
+proxy_cache_path {{ CACHE.path }} levels=1:2 keys_zone={{ CACHE.zone }}:{{ CACHE.zone_size }} max_size={{ CACHE.max_size }} inactive={{ CACHE.inactive }};
+{% endif %}
+
+{% if BACKENDS %}
+upstream propel_{{ NAME }} {
+    {% if UPSTREAM_BALANCE %}
+    {{ UPSTREAM_BALANCE }};
+    {% endif %}
+    {% for backend in BACKENDS %}
+    server {{ backend.address }}{% if backend.weight %} weight={{ backend.weight }}{% endif %};
+    {% endfor %}
+    {% if UPSTREAM_KEEPALIVE %}
+    keepalive {{ UPSTREAM_KEEPALIVE }};
+    {% endif %}
+}
+{% endif %}
+
 server {
     listen {{ PORT }};
     server_name {{ SERVER_NAME }};
     root {{ SET_PATH(DIRECTORY, ROOT_DIR) }};
 
     {% if LOGS_DIR %}
-    access_log {{ LOGS_DIR }}/access_{{ SERVER_NAME }}.log;
+    access_log {{ LOGS_DIR }}/access_{{ SERVER_NAME }}.log{% if ACCESS_LOG and ACCESS_LOG.params %} {{ ACCESS_LOG.params }}{% endif %};
     error_log {{ LOGS_DIR }}/error_{{ SERVER_NAME }}.log;
     {% endif %}
 
+    {% if BACKENDS and CACHE %}
+    add_header X-Cache-Status $upstream_cache_status;
+    {% endif %}
+
 {%- if SSL_DIRECTIVES %}
 
     {{ SSL_DIRECTIVES }}
@@ -172,15 +328,32 @@ server {
 
 
 {% if (not MAINTENANCE["ACTIVE"])  or (MAINTENANCE["ACTIVE"] and MAINTENANCE["ALLOW_IPS"]) %}
-    {% if PROXY_PORT %}
+    {% if BACKENDS %}
         location / {
-            proxy_pass http://127.0.0.1:{{ PROXY_PORT }}/;
+            proxy_pass http://propel_{{ NAME }}/;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_redirect off;
             proxy_set_header Host $host;
             proxy_set_header X-Real-IP $remote_addr;
             proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
             proxy_set_header X-Forwarded-Host $server_name;
             proxy_set_header X-Forwarded-Proto $scheme;
+            {%- if CACHE %}
+
+            proxy_cache {{ CACHE.zone }};
+            proxy_cache_key $scheme$request_method$host$request_uri;
+            {%- for status, ttl in CACHE.valid.items() %}
+            proxy_cache_valid {{ status }} {{ ttl }};
+            {%- endfor %}
+            proxy_cache_use_stale {{ CACHE.use_stale }};
+            proxy_cache_background_update on;
+            {%- if CACHE.lock %}
+            proxy_cache_lock on;
+            {%- endif %}
+            proxy_cache_bypass {{ CACHE.bypass }};
+            proxy_no_cache {{ CACHE.bypass }};
+            {%- endif %}
         }
 
     {% else %}
@@ -213,6 +386,27 @@ server {
     {%- for alias, location in ALIASES.items() %}
     location {{ alias }} {
         alias {{ SET_PATH(DIRECTORY, location) }} ;
+        {%- if STATIC %}
+        {%- if STATIC.expires %}
+        expires {{ STATIC.expires }};
+        {%- endif %}
+        {%- if STATIC.gzip_static %}
+        gzip_static on;
+        {%- endif %}
+        {%- if STATIC.brotli_static %}
+        brotli_static on;
+        {%- endif %}
+        {%- if STATIC.open_file_cache %}
+        open_file_cache {{ STATIC.open_file_cache }};
+        open_file_cache_valid 60s;
+        open_file_cache_min_uses 2;
+        open_file_cache_errors on;
+        {%- endif %}
+        {%- if STATIC.sendfile %}
+        sendfile on;
+        tcp_nopush on;
+        {%- endif %}
+        {%- endif %}
     }
     {% endfor -%}
 {% endif -%}
@@ -251,46 +445,169 @@ POST_RECEIVE_HOOK_CONFIG = """
 while read oldrev newrev refname
 do
     branch=$(git rev-parse --symbolic --abbrev-ref $refname)
-    if [ "master" = "$branch" ]; then
-        GIT_WORK_TREE={{ WORKING_DIR }} git checkout -f
+    if [ "{{ BRANCH }}" = "$branch" ]; then
+        # For `propel --incremental`
+        export PROPEL_OLDREV=$oldrev
+        export PROPEL_NEWREV=$newrev
+        export PROPEL_GIT_DIR=$(cd "${GIT_DIR:-.}" && pwd)
+        {% if RELEASES %}
+        # Checked out in releases/<commit>, then `current` is switched to it
+        propel --git-release {{ WORKING_DIR }} --releases {{ RELEASES }}
+        cd {{ WORKING_DIR }}/current
+        {% else %}
+        GIT_WORK_TREE={{ WORKING_DIR }} git checkout -f {{ BRANCH }}
         cd {{ WORKING_DIR }}
+        {% endif %}
         {{ COMMAND }}
     fi
 done
 """
 
+LOGROTATE_CONFIG = """
+{% for logs_dir in LOGS_DIRS %}{{ logs_dir }}/*.log {% endfor %}{
+    {{ FREQUENCY }}
+    rotate {{ ROTATE }}
+    {% if MAXSIZE %}maxsize {{ MAXSIZE }}{% endif %}
+    {% if COMPRESS %}compress
+    delaycompress{% endif %}
+    missingok
+    notifempty
+    sharedscripts
+    postrotate
+        {{ NGINX_BIN }} -s reopen > /dev/null 2>&1 || true
+    endscript
+}
+"""
+
 # ------------------------------------------------------------------------------
+TEMPLATES = {
+    "nginx.conf": NGINX_CONFIG,
+    "post-receive": POST_RECEIVE_HOOK_CONFIG,
+    "logrotate": LOGROTATE_CONFIG
+}
+_templates_env = None
+_templates_lock = threading.Lock()
+
+def get_template(name):
+    """
+    Return a compiled template. They are compiled once per run, from
+    TEMPLATES_DIRECTORY if it has a file of that name, else from TEMPLATES
+    :params name: The template name, ie: nginx.conf
+    :returns jinja2.Template:
+    """
+    global _templates_env
+    with _templates_lock:
+        if _templates_env is None:
+            bytecode_cache = None
+            if TEMPLATES_CACHE_DIRECTORY:
+                try:
+                    if not os.path.isdir(TEMPLATES_CACHE_DIRECTORY):
+                        os.makedirs(TEMPLATES_CACHE_DIRECTORY)
+                    bytecode_cache = FileSystemBytecodeCache(TEMPLATES_CACHE_DIRECTORY)
+                except OSError:  # Not writable by this user, compile in memory only
+                    pass
+            loader = ChoiceLoader([FileSystemLoader(TEMPLATES_DIRECTORY),
+                                   DictLoader(TEMPLATES)])
+            _templates_env = Environment(loader=loader,
+                                         bytecode_cache=bytecode_cache,
+                                         auto_reload=False)
+    return _templates_env.get_template(name)
+
+# The deploy step running in the current thread, see DeployGraph
+_step_context = threading.local()
+_print_lock = threading.Lock()
+
 def _print(text):
     """
-    Verbose print. Will print only if VERBOSE is ON
+    Verbose print. Will print only if VERBOSE is ON.
+    Inside a deploy step, each line is prefixed with the step name
     """
     if VERBOSE:
-        print(text)
+        step = getattr(_step_context, "step", None)
+        if step:
+            text = "\n".join(["[%s] %s" % (step.name, line)
+                              for line in ("%s" % text).split("\n")])
+        with _print_lock:
+            print(text)
+
+def _popen(args, **kwargs):
+    """
+    subprocess.Popen. Inside a deploy step, the process is tracked by the
+    step, to be stopped on timeout or cancellation
+    """
+    step = getattr(_step_context, "step", None)
+    if step is None:
+        return subprocess.Popen(args, **kwargs)
+    return step.popen(args, **kwargs)
+
+def _stream(process):
+    """
+    Print the output of a process as it comes, then wait for it
+    """
+    for line in iter(process.stdout.readline, b""):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        _print(line.rstrip("\n"))
+    process.stdout.close()
+    return process.wait()
 
 def run(cmd, verbose=True):
     """ Shortcut to subprocess.call """
     if verbose and VERBOSE:
-        subprocess.call(cmd.strip(), shell=True)
+        if getattr(_step_context, "step", None) is None:
+            subprocess.call(cmd.strip(), shell=True)
+        else:  # Concurrent steps get their output prefixed
+            _stream(_popen(cmd.strip(), shell=True,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT))
     else:
-        process = subprocess.Popen(cmd, shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
+        process = _popen(cmd, shell=True,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
         return process.communicate()[0]
 
-def runvenv(command, virtualenv=None):
+def runvenv(command, virtualenv=None, check=False):
     """
-    run with virtualenv with the help of .bashrc
+    run within a virtualenv. The command runs with the virtualenv environment
+    directly, without an interactive shell nor virtualenvwrapper
     :params command:
     :params  virtualenv: The venv name
+    :params check: If True, raise an exception when the command fails
     """
     kwargs = dict()
-    if not VERBOSE:
-        kwargs = dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if virtualenv:
-        command = "workon %s; %s; deactivate" % (virtualenv, command)
-    cmd = ["/bin/bash", "-i", "-c", command]
-    process = subprocess.Popen(cmd, **kwargs)
-    return process.communicate()[0]
+    stream = VERBOSE and getattr(_step_context, "step", None) is not None
+    if not VERBOSE or stream:
+        kwargs = dict(stdout=subprocess.PIPE,
+                      stderr=subprocess.STDOUT if stream else subprocess.PIPE)
+    cmd = ["/bin/bash", "-c", command]
+    process = _popen(cmd, env=get_venv_environ(virtualenv), **kwargs)
+    if stream:
+        output = None
+        _stream(process)
+    else:
+        output = process.communicate()[0]
+    if check and process.returncode:
+        raise Exception("Command '%s' failed with exit code %s" % (command, process.returncode))
+    return output
+
+_venv_environs = {}
+
+def get_venv_environ(virtualenv=None):
+    """
+    Return the environment to run commands in a virtualenv, as `workon` would set it.
+    It's resolved once per virtualenv
+    :params  virtualenv: The venv name
+    :returns dict:
+    """
+    if virtualenv not in _venv_environs:
+        environ = dict(os.environ)
+        if virtualenv:
+            environ["VIRTUAL_ENV"] = "%s/%s" % (VIRTUALENV_DIRECTORY, virtualenv)
+            environ["PATH"] = os.pathsep.join([get_venv_bin(virtualenv=virtualenv),
+                                               environ.get("PATH", "")])
+            environ.pop("PYTHONHOME", None)
+        _venv_environs[virtualenv] = environ
+    return _venv_environs[virtualenv]
 
 def get_venv_bin(bin_program=None, virtualenv=None):
     """
@@ -308,11 +625,312 @@ def is_port_open(port, host="127.0.0.1"):
     except Exception as e:
         return False
 
-def generate_random_port():
-    while True:
-        port = random.randrange(GUNICORN_PORT_RANGE[0], GUNICORN_PORT_RANGE[1])
-        if not is_port_open(port):
-            return port
+def is_socket_open(path):
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        s.close()
+        return True
+    except Exception as e:
+        return False
+
+def wait_for_socket(path, timeout=GUNICORN_BOOT_TIMEOUT):
+    """
+    Wait until a unix socket accepts connections
+    :params path:
+    :params timeout: Seconds to wait before giving up
+    :returns bool:
+    """
+    expires = time.time() + timeout
+    while time.time() < expires:
+        if is_socket_open(path):
+            return True
+        time.sleep(0.5)
+    return False
+
+def get_socket_dir(user):
+    """
+    Return the directory of the gunicorn unix sockets of a site user
+    """
+    return "%s/%s" % (GUNICORN_SOCKET_DIR, user)
+
+def setup_socket_dir(user):
+    """
+    Create the directory of the gunicorn unix sockets of a site user.
+    It's owned by the user, with the nginx group, and 0750: gunicorn creates
+    its sockets in it, nginx can reach them, and no other user can put a
+    socket in their place. As /run is cleared on boot, it's also added to
+    tmpfiles.d
+    """
+    group = get_dist_config("NGINX_GROUP")
+    directory = get_socket_dir(user)
+    if not os.path.isdir(GUNICORN_SOCKET_DIR):
+        os.makedirs(GUNICORN_SOCKET_DIR)
+    os.chmod(GUNICORN_SOCKET_DIR, 0o755)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    os.chown(directory, pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid)
+    os.chmod(directory, 0o750)
+
+    tmpfiles_conf = TMPFILES_CONF
+    if os.path.isdir(os.path.dirname(tmpfiles_conf)):
+        with _config_lock:
+            lines = []
+            if os.path.isfile(tmpfiles_conf):
+                with open(tmpfiles_conf) as f:
+                    lines = [line for line in f.read().splitlines()
+                             if line and line.split()[1] != GUNICORN_SOCKET_DIR]
+            entry = "d %s 0750 %s %s -" % (directory, user, group)
+            if entry not in lines:
+                lines = ["d %s 0755 root root -" % GUNICORN_SOCKET_DIR] + \
+                        [line for line in lines if line.split()[1] != directory] + [entry]
+                with open(tmpfiles_conf, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+
+def wait_for_backend(address, timeout=GUNICORN_BOOT_TIMEOUT):
+    """
+    Wait until a backend accepts connections
+    :params address: 'unix:/path/to.sock' or 'host:port'
+    :params timeout: Seconds to wait before giving up
+    :returns bool:
+    """
+    if address.startswith("unix:"):
+        return wait_for_socket(address[5:], timeout=timeout)
+    host, port = address.rsplit(":", 1)
+    return wait_for_port(port, timeout=timeout, host=host)
+
+def wait_for_port(port, timeout=GUNICORN_BOOT_TIMEOUT, host="127.0.0.1"):
+    """
+    Wait until a port accepts connections
+    :params port:
+    :params timeout: Seconds to wait before giving up
+    :returns bool:
+    """
+    expires = time.time() + timeout
+    while time.time() < expires:
+        if is_port_open(port, host):
+            return True
+        time.sleep(0.5)
+    return False
+
+def probe_backend(address, path="/", timeout=5, host=None):
+    """
+    Send a GET request to a backend
+    :params address: 'unix:/path/to.sock' or 'host:port'
+    :params path: The path requested
+    :params timeout: Seconds to wait for the connection and the response
+    :params host: The Host header
+    :returns int: The response status
+    """
+    if address.startswith("unix:"):
+        conn = UnixStreamHTTPConnection(address[5:], timeout=timeout)
+    else:
+        conn_host, port = address.rsplit(":", 1)
+        conn = httplib.HTTPConnection(conn_host, int(port), timeout=timeout)
+    try:
+        conn.request("GET", path, headers={"Host": host} if host else {})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+def check_backend(address, options, boot_timeout=0):
+    """
+    Probe a backend until it answers with the expected status
+    :params address: 'unix:/path/to.sock' or 'host:port'
+    :params options: The healthcheck options, see HEALTHCHECK_DEFAULTS
+    :params boot_timeout: Seconds to wait for it to accept connections first
+    :returns tuple: (bool, the last error)
+    """
+    if boot_timeout and not wait_for_backend(address, timeout=boot_timeout):
+        return False, "no connection after %ss" % boot_timeout
+    expected = options["status"] if isinstance(options["status"], list) \
+        else [options["status"]]
+    expected = [int(status) for status in expected]
+    error = None
+    for attempt in range(max(1, int(options["retries"]))):
+        if attempt:
+            time.sleep(options["interval"])
+        try:
+            status = probe_backend(address, path=options["path"],
+                                   timeout=options["timeout"], host=options["host"])
+            if status in expected:
+                return True, None
+            error = "HTTP %s, expected %s" % (status, "/".join([str(s) for s in expected]))
+        except (socket.error, httplib.HTTPException) as ex:
+            error = str(ex) or ex.__class__.__name__
+    return False, error
+
+def check_backends(addresses, options, boot_timeout=0):
+    """
+    Probe backends concurrently, `concurrency` of them at a time
+    :params addresses: list of 'unix:/path/to.sock' or 'host:port'
+    :params options: The healthcheck options, see HEALTHCHECK_DEFAULTS
+    :params boot_timeout: Seconds to wait for each to accept connections first
+    :returns list: The (address, error) of the backends that failed
+    """
+    check = lambda address: (address,) + check_backend(address, options, boot_timeout)
+    concurrency = min(int(options["concurrency"]), len(addresses))
+    if concurrency > 1:
+        pool = multiprocessing.pool.ThreadPool(concurrency)
+        try:
+            results = pool.map(check, addresses)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [check(address) for address in addresses]
+    return [(address, error) for address, ok, error in results if not ok]
+
+def is_port_free(port, host="0.0.0.0"):
+    """
+    Check that a port can be bound
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, int(port)))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+class PortRegistry(object):
+    """
+    Persistent registry of the ports assigned to the gunicorn programs, so
+    each program keeps the same port across deployments.
+    Released ports are reused first, otherwise the next port of the range is
+    taken. The port of a program is checked to still be free, unless the
+    program is running on it. The file is locked while updated.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, registry_file=GUNICORN_PORTS_REGISTRY, port_range=GUNICORN_PORT_RANGE):
+        self.registry_file = registry_file
+        self.port_range = port_range
+
+    @contextlib.contextmanager
+    def open(self):
+        """
+        Lock the registry and yield its data, which is saved on exit
+        """
+        directory = os.path.dirname(self.registry_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            with open(self.registry_file + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    data = {"ports": {}, "free": [], "next": self.port_range[0]}
+                    if os.path.isfile(self.registry_file):
+                        with open(self.registry_file) as f:
+                            data.update(json.load(f))
+                    yield data
+                    if DRY_RUN:
+                        return
+                    tmp_file = "%s.%s" % (self.registry_file, os.getpid())
+                    with open(tmp_file, "w") as f:
+                        json.dump(data, f, indent=2, sort_keys=True)
+                    os.rename(tmp_file, self.registry_file)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, name):
+        """
+        Return the port of a program, or None
+        """
+        with self.open() as data:
+            return data["ports"].get(name)
+
+    def allocate(self, name):
+        """
+        Return the port of a program, assigning a free one the first time
+        """
+        with self.open() as data:
+            if name in data["ports"]:
+                port = data["ports"][name]
+                # Bound by the program itself, or free. Otherwise it's taken
+                # by another process since, and the program gets a new one
+                if is_port_free(port) or Supervisor.status(name) in ("RUNNING", "STARTING",
+                                                                     "BACKOFF"):
+                    return port
+                del data["ports"][name]
+            while data["free"]:
+                port = data["free"].pop(0)
+                if is_port_free(port):
+                    data["ports"][name] = port
+                    return port
+            while data["next"] < self.port_range[1]:
+                port = data["next"]
+                data["next"] += 1
+                if is_port_free(port):
+                    data["ports"][name] = port
+                    return port
+            # The range was used up once, look for ports left unassigned
+            assigned = set(data["ports"].values())
+            for port in range(self.port_range[0], self.port_range[1]):
+                if port not in assigned and is_port_free(port):
+                    data["ports"][name] = port
+                    return port
+        raise Exception("No free port left in range %s-%s" % tuple(self.port_range))
+
+    def release(self, name):
+        """
+        Release the port of a program
+        """
+        with self.open() as data:
+            port = data["ports"].pop(name, None)
+            if port and port not in data["free"]:
+                data["free"].append(port)
+
+def precompress_static(directory, extensions=STATIC_PRECOMPRESS_EXTENSIONS,
+                       min_size=STATIC_PRECOMPRESS_MIN_SIZE, use_brotli=False):
+    """
+    Write a .gz (and .br) copy next to each static file, for nginx gzip_static
+    and brotli_static. Copies that are newer than their file are left as is
+    :params directory: The static directory
+    :params extensions: Extensions of the files to compress
+    :params min_size: Files smaller than that are skipped
+    :params use_brotli: Also write .br. Requires the brotli package
+    :returns int: Number of files written
+    """
+    if use_brotli and brotli is None:
+        _print("Brotli is missing, .br files are skipped. pip install brotli")
+        use_brotli = False
+    written = 0
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() not in extensions:
+                continue
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            if stat.st_size < min_size:
+                continue
+            targets = [".gz"] + ([".br"] if use_brotli else [])
+            targets = [ext for ext in targets
+                       if not os.path.isfile(path + ext)
+                       or int(os.stat(path + ext).st_mtime) < int(stat.st_mtime)]
+            if not targets:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for ext in targets:
+                tmp_file = "%s%s.tmp" % (path, ext)
+                if ext == ".gz":
+                    with open(tmp_file, "wb") as f:
+                        gz = gzip.GzipFile(filename, "wb", 9, f, mtime=stat.st_mtime)
+                        gz.write(data)
+                        gz.close()
+                else:
+                    with open(tmp_file, "wb") as f:
+                        f.write(brotli.compress(data))
+                os.utime(tmp_file, (stat.st_atime, stat.st_mtime))
+                os.rename(tmp_file, path + ext)
+                written += 1
+    return written
 
 def get_dist():
     """
@@ -338,22 +956,503 @@ def get_dist_config(key):
         return DIST_CONF[dist].get(key)
     raise AttributeError("Dist config '%s' not found" % key)
 
-def reload_services():
-    for svc in get_dist_config("RELOAD_PROGRAMS"):
-        run("sudo service %s reload" % svc)
+def reload_services(force=True, paths=None):
+    """
+    Reload nginx and php-fpm
+    :params force: When False, only reload if a site config changed since the last reload
+    :params paths: Only commit these staged site configs, see Nginx.commit()
+    """
+    if DRY_RUN:
+        return
+    with _config_lock:
+        # The valid configs are promoted even if others were rejected, so
+        # they're reloaded before raising
+        error = None
+        try:
+            Nginx.commit(paths)
+        except Exception as ex:
+            error = ex
+        if not force and not config_changed("nginx"):
+            _print("==== No site config changed, reload skipped")
+        else:
+            for svc in get_dist_config("RELOAD_PROGRAMS"):
+                run("sudo service %s reload" % svc)
+            _config_snapshots.pop("nginx", None)
+        if error:
+            raise error
+
+# Config files
+# Hash of each config file when first written in this run, by group, to tell
+# if the services have to reload at the end
+_config_snapshots = {}
+_config_lock = threading.RLock()
+
+def _file_hash(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def write_config(path, content, group=None):
+    """
+    Write a config file atomically, only if its content changed.
+    With DRY_RUN, print the diff instead
+    :params path: The config file
+    :params content: The new content
+    :params group: Changes are tracked by group, ie: nginx, see config_changed()
+    :returns bool: True if the content changed
+    """
+    if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+    current = None
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            current = f.read()
+    if current is not None and \
+            hashlib.sha1(current).hexdigest() == hashlib.sha1(content).hexdigest():
+        return False
+
+    if DRY_RUN:
+        diff = difflib.unified_diff((current or b"").decode("utf-8", "replace").splitlines(True),
+                                    content.decode("utf-8", "replace").splitlines(True),
+                                    path if current is not None else "/dev/null", path)
+        with _print_lock:  # Diffs of concurrent deploy steps don't interleave
+            print("".join(diff))
+        return True
+
+    with _config_lock:
+        _config_snapshots.setdefault(group, {}).setdefault(path, _file_hash(path))
+    # The temp file goes in the parent directory: nginx and supervisor include
+    # every file of the config directory. Same filesystem, so rename is atomic
+    fd, tmp_file = tempfile.mkstemp(prefix=".propel-",
+                                    dir=os.path.dirname(os.path.dirname(os.path.abspath(path))))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, path)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return True
+
+def remove_config(path, group=None):
+    """
+    Remove a config file. With DRY_RUN, only print it
+    :returns bool: True if there was a file
+    """
+    if not os.path.isfile(path):
+        return False
+    if DRY_RUN:
+        print("--- %s\n+++ /dev/null\n" % path)
+        return True
+    with _config_lock:
+        _config_snapshots.setdefault(group, {}).setdefault(path, _file_hash(path))
+    os.remove(path)
+    return True
+
+def config_changed(group=None):
+    """
+    Tell if a config file of the group is different than when it was first
+    written in this run. A site put under maintenance then redeployed as it
+    was is not a change
+    """
+    with _config_lock:
+        return any(_file_hash(path) != original
+                   for path, original in _config_snapshots.get(group, {}).items())
 
 def get_domain_conf_file(domain):
     return get_dist_config("NGINX_CONF_FILE") % domain
 
-# VirtualenvWrapper
-def virtualenv_make(name):
-    runvenv("mkvirtualenv %s" % name)
+class Nginx(object):
+    """
+    Site configs are staged, then validated with `nginx -t` against a copy
+    of the nginx config, before replacing the live ones. A bad site config
+    never reaches nginx, so it can't take the other sites down with it
+
+        Nginx.stage(path, content)
+        Nginx.commit()
+    """
+    _staged = {}  # path: content, None to remove
+    _lock = threading.RLock()
+
+    @classmethod
+    def stage(cls, path, content):
+        """
+        Stage the content of a site config. With DRY_RUN, print its diff
+        """
+        if DRY_RUN:
+            return write_config(path, content, group="nginx")
+        with cls._lock:
+            cls._staged[path] = content
+
+    @classmethod
+    def remove(cls, path):
+        """
+        Stage the removal of a site config
+        """
+        if DRY_RUN:
+            return remove_config(path, group="nginx")
+        with cls._lock:
+            cls._staged[path] = None
+
+    @classmethod
+    def discard(cls, path):
+        """
+        Drop the staged change of a site config, the live one stays
+        """
+        with cls._lock:
+            cls._staged.pop(path, None)
+
+    @classmethod
+    def test(cls, conf_file=None):
+        """
+        Run `nginx -t`
+        :params conf_file: The main config to test, the live one by default
+        :returns tuple: (bool, output)
+        """
+        command = [NGINX_BIN, "-t"] + (["-c", conf_file] if conf_file else [])
+        try:
+            process = subprocess.Popen(command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError as ex:
+            return False, "%s: %s" % (NGINX_BIN, ex)
+        output = process.communicate()[0]
+        if isinstance(output, bytes):
+            output = output.decode("utf-8", "replace")
+        return process.returncode == 0, output.strip()
+
+    @classmethod
+    def validate(cls, staged):
+        """
+        Test the staged configs. The nginx config directory is mirrored in a
+        temporary directory with symlinks, except for the sites directory,
+        which is a copy with the staged configs in it. The main config is
+        copied with its include of the sites directory pointed to the copy
+        :params staged: dict of path: content
+        :returns tuple: (bool, output)
+        """
+        conf_dir = os.path.dirname(NGINX_MAIN_CONF)
+        sites_dir = os.path.dirname(get_domain_conf_file("_"))
+        staging_dir = tempfile.mkdtemp(prefix="propel-nginx-")
+        try:
+            staging_sites_dir = os.path.join(staging_dir, "propel-sites")
+            os.makedirs(staging_sites_dir)
+            # Relative includes, ie: mime.types, fastcgi_params, resolve from the staging dir
+            for entry in os.listdir(conf_dir):
+                path = os.path.join(conf_dir, entry)
+                if path not in (NGINX_MAIN_CONF, sites_dir):
+                    os.symlink(path, os.path.join(staging_dir, entry))
+            if os.path.isdir(sites_dir):
+                for entry in os.listdir(sites_dir):
+                    path = os.path.join(sites_dir, entry)
+                    if os.path.isfile(path):
+                        shutil.copyfile(path, os.path.join(staging_sites_dir, entry))
+            for path, content in staged.items():
+                staging_file = os.path.join(staging_sites_dir, os.path.basename(path))
+                if content is None:
+                    if os.path.isfile(staging_file):
+                        os.remove(staging_file)
+                else:
+                    with open(staging_file, "wb") as f:
+                        f.write(content.encode("utf-8") if not isinstance(content, bytes)
+                                else content)
+
+            with open(NGINX_MAIN_CONF) as f:
+                main_conf = f.read()
+            main_conf = re.sub(r"(include\s+)%s/" % re.escape(sites_dir),
+                               r"\g<1>%s/" % staging_sites_dir, main_conf)
+            if sites_dir.startswith(conf_dir + "/"):
+                main_conf = re.sub(r"(include\s+)%s/" % re.escape(os.path.relpath(sites_dir, conf_dir)),
+                                   r"\g<1>%s/" % staging_sites_dir, main_conf)
+            staging_conf = os.path.join(staging_dir, os.path.basename(NGINX_MAIN_CONF))
+            with open(staging_conf, "w") as f:
+                f.write(main_conf)
+
+            ok, output = cls.test(staging_conf)
+            return ok, output.replace(staging_sites_dir, sites_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    @classmethod
+    def commit(cls, paths=None):
+        """
+        Validate the staged configs, then replace the live ones with them.
+        A config failing `nginx -t` is dropped, the valid ones are still
+        promoted, then it raises. If the live config then fails `nginx -t`,
+        the previous configs are put back and it raises
+        :params paths: Only commit these configs, ie: the one of a site.
+                       The others stay staged
+        :returns bool: True if configs were promoted
+        """
+        with cls._lock:
+            if paths is None:
+                staged, cls._staged = cls._staged, {}
+            else:
+                staged = dict([(path, cls._staged.pop(path)) for path in paths
+                               if path in cls._staged])
+            if not staged:
+                return False
+
+            errors = []
+            ok, output = cls.validate(staged)
+            if not ok:
+                # Each config is tested on its own against the live ones, to
+                # find the ones at fault
+                for path in sorted(staged):
+                    path_ok, path_output = cls.validate({path: staged[path]})
+                    if not path_ok:
+                        errors.append((path, path_output))
+                        del staged[path]
+                if staged:
+                    ok, output = cls.validate(staged)
+                if not staged or not ok:
+                    raise Exception("Nginx config is invalid, the sites were not changed:\n%s"
+                                    % output)
+
+            backups = {}
+            for path in staged:
+                backups[path] = None
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        backups[path] = f.read()
+            try:
+                for path, content in staged.items():
+                    if content is None:
+                        remove_config(path, group="nginx")
+                    else:
+                        write_config(path, content, group="nginx")
+                ok, output = cls.test()
+                if not ok:
+                    raise Exception("Nginx config is invalid once promoted, "
+                                    "the previous sites were restored:\n%s" % output)
+            except Exception:
+                for path, content in backups.items():
+                    if content is None:
+                        remove_config(path, group="nginx")
+                    else:
+                        write_config(path, content, group="nginx")
+                raise
+            if errors:
+                raise Exception("Nginx config is invalid, these sites were not changed: %s\n%s"
+                                % (", ".join([path for path, _ in errors]),
+                                   "\n".join([error for _, error in errors])))
+            return True
+
+# Virtualenv
+# Virtualenvs are created in the virtualenvwrapper directory, so `workon` still works
+def virtualenv_make(name, wheelhouse=False):
+    """
+    Create a virtualenv with the default packages
+    :params name: The venv name
+    :params wheelhouse: If True, install the default packages from the wheelhouse
+    """
+    if not os.path.isdir(VIRTUALENV_DIRECTORY):
+        os.makedirs(VIRTUALENV_DIRECTORY)
+    runvenv("%s -m virtualenv %s/%s" % (PY_EXECUTABLE, VIRTUALENV_DIRECTORY, name))
     pip = get_venv_bin(bin_program="pip", virtualenv=name)
     packages = " ".join([p for p in VIRTUALENV_DEFAULT_PACKAGES])
-    runvenv("%s install %s" % (pip, packages), virtualenv=name)
+    options = ""
+    if wheelhouse:
+        key = hashlib.sha1((packages + get_python_version(name)).encode("utf-8")).hexdigest()
+        if not wheelhouse_complete(key):
+            wheelhouse_build(packages, key, virtualenv=name)
+        options = wheelhouse_options(key)
+    runvenv("%s install %s %s" % (pip, options, packages), virtualenv=name)
 
 def virtualenv_remove(name):
-    runvenv("rmvirtualenv %s" % name)
+    path = "%s/%s" % (VIRTUALENV_DIRECTORY, name)
+    if os.path.islink(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+def virtualenv_swap(name, generation):
+    """
+    Point the virtualenv name to a generation, with an atomic symlink swap
+    :params name: The venv name
+    :params generation: The venv directory name to point to, ie: <name>-<timestamp>
+    """
+    path = "%s/%s" % (VIRTUALENV_DIRECTORY, name)
+    # A virtualenv not built by generation is kept as one, to be collected later
+    if os.path.isdir(path) and not os.path.islink(path):
+        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        while os.path.exists("%s-%s" % (path, mtime.strftime("%Y%m%d%H%M%S"))):
+            mtime -= datetime.timedelta(seconds=1)
+        os.rename(path, "%s-%s" % (path, mtime.strftime("%Y%m%d%H%M%S")))
+    tmp_link = "%s.propel-%s" % (path, os.getpid())
+    os.symlink(generation, tmp_link)
+    os.rename(tmp_link, path)
+
+def virtualenv_collect(name, keep=VIRTUALENV_KEEP_GENERATIONS):
+    """
+    Remove the old generations of a virtualenv. The live one is always kept
+    :params name: The venv name
+    :params keep: Number of generations to keep, including the live one
+    """
+    if not os.path.isdir(VIRTUALENV_DIRECTORY):
+        return
+    path = "%s/%s" % (VIRTUALENV_DIRECTORY, name)
+    live = os.readlink(path) if os.path.islink(path) else None
+    pattern = re.compile(r"^%s-\d{14}$" % re.escape(name))
+    generations = sorted([d for d in os.listdir(VIRTUALENV_DIRECTORY) if pattern.match(d)],
+                         reverse=True)
+    kept = [live] if live in generations else []
+    for generation in generations:
+        if generation in kept:
+            continue
+        if len(kept) < keep:
+            kept.append(generation)
+        else:
+            shutil.rmtree("%s/%s" % (VIRTUALENV_DIRECTORY, generation))
+
+def parse_size(size):
+    """
+    Return a size in bytes
+    :params size: (int or string) ie: 1024, 512K, 150M, 2G
+    :returns int:
+    """
+    match = re.match(r"^(\d+)\s*([KMG]?)B?$", str(size).strip().upper())
+    if not match:
+        raise ValueError("Invalid size '%s', ie: 150M" % size)
+    return int(match.group(1)) * {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[match.group(2)]
+
+def get_host_resources():
+    """
+    Return the number of cpus and the total memory of the host
+    :returns tuple: (cpus, bytes)
+    """
+    memory = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except IOError:
+        pass
+    return multiprocessing.cpu_count(), memory
+
+def get_process_children(pid):
+    """
+    Return the pids of the children of a process
+    """
+    children_file = "/proc/%s/task/%s/children" % (pid, pid)
+    if os.path.isfile(children_file):
+        with open(children_file) as f:
+            return [int(child) for child in f.read().split()]
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/%s/stat" % entry) as f:
+                    # The command is in parentheses and may contain spaces
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == int(pid):
+                        children.append(int(entry))
+            except (IOError, IndexError, ValueError):
+                pass
+    return children
+
+def get_process_start_time(pid):
+    """
+    Return the timestamp a process started at, None if it's gone
+    """
+    try:
+        with open("/proc/%s/stat" % pid) as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = int([line.split()[1] for line in f if line.startswith("btime")][0])
+    except (IOError, IndexError, ValueError):
+        return None
+    return boot_time + float(ticks) / os.sysconf("SC_CLK_TCK")
+
+def get_process_rss(pid):
+    """
+    Return the resident memory of a process in bytes, None if it's gone
+    """
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def get_python_version(virtualenv=None):
+    """
+    Return the full version string of the virtualenv Python, as text
+    """
+    python = get_venv_bin(bin_program="python", virtualenv=virtualenv)
+    version = run("%s -c 'import sys; print(sys.version)'" % python, verbose=False) or ""
+    if isinstance(version, bytes):
+        version = version.decode("utf-8", "replace")
+    return version
+
+# Wheelhouse
+# Wheels are shared by all virtualenvs. A set of requirements is marked complete
+# once all its wheels are built, then it's installed offline with --no-index
+def wheelhouse_complete(key):
+    return os.path.isfile("%s/.complete-%s" % (WHEELHOUSE_DIRECTORY, key))
+
+def wheelhouse_options(key, no_index=True):
+    """
+    Return the pip install options to use the wheelhouse
+    :params no_index: If False, the index is kept even if the wheelhouse is
+                      complete, ie: for VCS and editable requirements
+    """
+    options = "--find-links %s" % WHEELHOUSE_DIRECTORY
+    if no_index and wheelhouse_complete(key):
+        options = "--no-index %s" % options
+    return options
+
+def requirements_need_index(requirements_file):
+    """
+    Tell if a requirements file, or a file it refers to with -r/-c, has VCS,
+    URL or editable requirements. pip can't install them from wheels only
+    """
+    files = [requirements_file]
+    while files:
+        requirements_file = files.pop(0)
+        if not os.path.isfile(requirements_file):
+            continue
+        with open(requirements_file) as f:
+            for line in f:
+                _ = line.split()
+                if not _ or _[0].startswith("#"):
+                    continue
+                if _[0] in ("-e", "--editable") or _[0].startswith("--editable=") \
+                        or "://" in _[0] or re.match(r"^(git|hg|svn|bzr)\+", _[0]):
+                    return True
+                if len(_) > 1 and _[0] in ("-r", "--requirement", "-c", "--constraint"):
+                    files.append(os.path.join(os.path.dirname(requirements_file), _[1]))
+    return False
+
+def wheelhouse_build(requirements, key, virtualenv=None):
+    """
+    Build the wheels of requirements into the wheelhouse
+    :params requirements: Packages or '-r requirements.txt'
+    :params key: The key to mark the requirements complete with
+    :params virtualenv: The venv to build with
+    :returns bool:
+    """
+    if not os.path.isdir(WHEELHOUSE_DIRECTORY):
+        os.makedirs(WHEELHOUSE_DIRECTORY)
+    pip = get_venv_bin(bin_program="pip", virtualenv=virtualenv)
+    try:
+        runvenv("%s wheel --wheel-dir %s --find-links %s %s"
+                % (pip, WHEELHOUSE_DIRECTORY, WHEELHOUSE_DIRECTORY, requirements),
+                virtualenv=virtualenv, check=True)
+    except Exception as ex:
+        _print("==== Building wheels failed: %s" % ex)
+        return False
+    with open("%s/.complete-%s" % (WHEELHOUSE_DIRECTORY, key), "w") as f:
+        f.write(requirements)
+    return True
 
 # Deployment
 def get_deploy_config(directory):
@@ -381,27 +1480,231 @@ def reload_server():
     reload_services()
     Supervisor.reload()
 
+class UnixStreamHTTPConnection(httplib.HTTPConnection):
+    """
+    HTTP connection over a unix socket
+    """
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.socket_timeout:
+            self.sock.settimeout(self.socket_timeout)
+        self.sock.connect(self.socket_path)
+
+class UnixStreamTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport keeping a single connection to a unix socket
+    """
+    def __init__(self, socket_path):
+        xmlrpclib.Transport.__init__(self)
+        self.socket_path = socket_path
+
+    def make_connection(self, host):
+        if not self._connection[1]:
+            self._connection = host, UnixStreamHTTPConnection(self.socket_path)
+        return self._connection[1]
+
 class Supervisor(object):
     """
     Supervisor Class
+
+    Talks to supervisord over its XML-RPC unix socket, with one connection
+    per thread for the whole propel run. Falls back to supervisorctl.
     """
 
+    _rpc_socket = None  # None: not probed yet, False: not available
+    _local = threading.local()
+    _lock = threading.RLock()
+    _connection_errors = (socket.error, xmlrpclib.ProtocolError, httplib.HTTPException)
+    _batch = None  # Programs to start when the batch commits
+    _batch_depth = 0
+    _batch_changed = set()  # Programs of the batch whose conf changed
+    _batch_restart = set()  # Running programs of the batch to stop right before their start
+    jobs = DEPLOY_JOBS  # Programs started concurrently when a batch commits
+
+    @classmethod
+    def rpc(cls):
+        """
+        Return the supervisord XML-RPC proxy of the current thread,
+        or None if not available
+        """
+        with cls._lock:
+            if cls._rpc_socket is None:
+                cls._rpc_socket = False
+                for path in SUPERVISOR_SOCKETS:
+                    if not os.path.exists(path):
+                        continue
+                    proxy = xmlrpclib.ServerProxy("http://localhost",
+                                                  transport=UnixStreamTransport(path))
+                    try:
+                        proxy.supervisor.getState()
+                        cls._rpc_socket = path
+                        cls._local.proxy = proxy.supervisor
+                        break
+                    except cls._connection_errors + (xmlrpclib.Fault,):
+                        continue
+        if cls._rpc_socket is False:
+            return None
+        # The proxy can't be truth tested, it would be sent as a remote call
+        if getattr(cls._local, "proxy", None) is None:
+            transport = UnixStreamTransport(cls._rpc_socket)
+            cls._local.proxy = xmlrpclib.ServerProxy("http://localhost",
+                                                     transport=transport).supervisor
+        return cls._local.proxy
+
+    @classmethod
+    def _call(cls, method, *args):
+        """
+        Call an XML-RPC method. Faults are printed, as supervisorctl would
+        :returns: The result, or None on fault
+        :raises socket.error: When the connection is lost
+        """
+        try:
+            return getattr(cls.rpc(), method)(*args)
+        except xmlrpclib.Fault as fault:
+            _print("%s: %s" % (" ".join([method] + [str(a) for a in args]), fault.faultString))
+        except cls._connection_errors:
+            cls._rpc_socket = False
+            raise socket.error("Lost connection to supervisord")
+
     @classmethod
     def ctl(cls, action, name):
+        if cls.rpc() is not None:
+            try:
+                if action == "start":
+                    return cls._call("startProcess", name)
+                elif action == "stop":
+                    return cls._call("stopProcess", name)
+                elif action == "remove":
+                    return cls._call("removeProcessGroup", name)
+                elif action == "restart" and name == "all":
+                    cls._call("stopAllProcesses")
+                    return cls._call("startAllProcesses")
+                elif action == "reread":  # Only compares, `update` applies
+                    return cls._call("reloadConfig")
+                elif action == "update":
+                    return cls.reload(groups=[name] if name else None)
+            except socket.error:
+                pass
         return run("%s %s %s" % (SUPERVISOR_CTL, action, name))
 
+    @classmethod
+    def signal(cls, name, sig="HUP"):
+        """
+        Send a signal to the processes of a program, ie: HUP for gunicorn
+        to reload its workers gracefully
+        """
+        if cls.rpc() is not None:
+            try:
+                return cls._call("signalProcessGroup", name, sig)
+            except socket.error:
+                pass
+        return run("%s signal %s %s:*" % (SUPERVISOR_CTL, sig, name))
+
+    @classmethod
+    def reload_gracefully(cls, name, timeout=GUNICORN_BOOT_TIMEOUT, not_before=None):
+        """
+        Reload a running gunicorn program with HUP: its master starts new
+        workers with the new code, then stops the previous ones once they
+        finished their requests. Wait until all its workers are new
+        :params name: The program name
+        :params timeout: Seconds to wait for the new workers
+        :params not_before: If a master was started before that timestamp,
+                            ie: its virtualenv was rebuilt since, don't reload
+        :returns bool: False if it has to be restarted instead
+        """
+        masters = cls.pids(name)
+        if not masters:
+            return False
+        if not_before and any([(get_process_start_time(pid) or 0) < not_before
+                               for pid in masters]):
+            return False
+        previous = dict([(pid, set(get_process_children(pid))) for pid in masters])
+        cls.signal(name, "HUP")
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(0.5)
+            if sorted(cls.pids(name)) != sorted(masters):  # A master exited, ie: failed to boot
+                return False
+            workers = dict([(pid, set(get_process_children(pid))) for pid in masters])
+            if all([workers[pid] and not workers[pid] & previous[pid] for pid in masters]):
+                return True
+        return False
+
     @classmethod
     def status(cls, name):
-        status = run("%s %s %s" % (SUPERVISOR_CTL, "status", name), verbose=False)
-        if status:
-            _status = ' '.join(status.split()).split(" ")
-            if _status[0] == name:
-                return _status[1]
-        return None
+        """
+        Return the state of a program. For a program with numprocs, the state
+        of the first process not RUNNING, if any
+        """
+        # A single process is looked up alone, not among all the programs
+        if cls.rpc() is not None:
+            try:
+                return cls.rpc().getProcessInfo("%s:%s" % (name, name))["statename"]
+            except xmlrpclib.Fault:  # BAD_NAME: unknown, or with numprocs
+                pass
+            except cls._connection_errors:
+                cls._rpc_socket = False
+        states = [state for _, state in cls.statuses(name)]
+        if not states:
+            return None
+        return ([state for state in states if state != "RUNNING"] or states)[0]
+
+    @classmethod
+    def statuses(cls, name):
+        """
+        Return the (process name, state) of all the processes of a program
+        """
+        if cls.rpc() is not None:
+            try:
+                return [(info["name"], info["statename"])
+                        for info in cls.rpc().getAllProcessInfo()
+                        if info["group"] == name]
+            except cls._connection_errors:
+                cls._rpc_socket = False
+
+        statuses = []
+        _ = run("%s %s %s:*" % (SUPERVISOR_CTL, "status", name), verbose=False) or ""
+        for line in _.split("\n"):
+            _status = ' '.join(line.split()).split(" ")
+            if len(_status) > 1 and _status[0].split(":")[0] == name:
+                statuses.append((_status[0].split(":")[-1], _status[1]))
+        return statuses
+
+    @classmethod
+    def pids(cls, name):
+        """
+        Return the pids of the running processes of a program
+        """
+        if cls.rpc() is not None:
+            try:
+                return [info["pid"] for info in cls.rpc().getAllProcessInfo()
+                        if info["group"] == name and info["pid"]]
+            except cls._connection_errors:
+                cls._rpc_socket = False
+        _ = run("%s %s %s:*" % (SUPERVISOR_CTL, "pid", name), verbose=False) or ""
+        return [int(pid) for pid in _.split() if pid.isdigit() and int(pid)]
 
     @classmethod
     def list_status(cls):
         statuses = []
+        if cls.rpc() is not None:
+            try:
+                for info in cls.rpc().getAllProcessInfo():
+                    name = info["name"]
+                    if info["group"] != name:
+                        name = "%s:%s" % (info["group"], name)
+                    if "propel-" in name:
+                        statuses.append("%-32s %-10s %s" % (name, info["statename"],
+                                                            info["description"]))
+                return statuses
+            except cls._connection_errors:
+                cls._rpc_socket = False
+
         _ = run("%s %s %s" % (SUPERVISOR_CTL, "status", ""), verbose=False)
         for line in _.split("\n"):
             _status = ' '.join(line.split()).split(" ")
@@ -411,7 +1714,51 @@ class Supervisor(object):
         return statuses
 
     @classmethod
-    def start(cls, name, command, directory="/", user="root", environment=None):
+    def get_options(cls, options, name=""):
+        """
+        Validate the `supervisor` options of a program, and fill in the defaults
+        :params options: dict of program options, see SUPERVISOR_OPTIONS
+        :params name: The program name, for the errors
+        :returns dict:
+        """
+        if not isinstance(options or {}, dict):
+            raise TypeError("'supervisor' of '%s' must be a dict" % name)
+        _options = dict(SUPERVISOR_DEFAULT_OPTIONS)
+        for key, value in (options or {}).items():
+            kind = SUPERVISOR_OPTIONS.get(key)
+            if kind is None:
+                raise ValueError("Unknown supervisor option '%s' in '%s'. Valid options: %s"
+                                 % (key, name, ", ".join(sorted(SUPERVISOR_OPTIONS))))
+            if kind == "int" and (isinstance(value, bool) or not isinstance(value, int)
+                                  or value < 0):
+                raise ValueError("Supervisor option '%s' of '%s' must be a positive int"
+                                 % (key, name))
+            elif key == "numprocs" and value < 1:
+                raise ValueError("Supervisor option 'numprocs' of '%s' must be at least 1" % name)
+            elif kind == "nice" and (isinstance(value, bool) or not isinstance(value, int)
+                                     or not -20 <= value <= 19):
+                raise ValueError("Supervisor option 'nice' of '%s' must be between -20 and 19"
+                                 % name)
+            elif kind == "bool" and not isinstance(value, bool):
+                raise ValueError("Supervisor option '%s' of '%s' must be True or False"
+                                 % (key, name))
+            elif kind == "autorestart" and not (isinstance(value, bool) or value == "unexpected"):
+                raise ValueError("Supervisor option 'autorestart' of '%s' must be True, False "
+                                 "or 'unexpected'" % name)
+            elif kind == "signal":
+                value = str(value).upper()
+                if value not in SUPERVISOR_SIGNALS:
+                    raise ValueError("Supervisor option 'stopsignal' of '%s' must be one of: %s"
+                                     % (name, ", ".join(SUPERVISOR_SIGNALS)))
+            elif kind == "size" and not re.match(r"^\d+(KB|MB|GB)?$", str(value)):
+                raise ValueError("Supervisor option '%s' of '%s' must be a size, ie: 50MB"
+                                 % (key, name))
+            _options[key] = value
+        return _options
+
+    @classmethod
+    def start(cls, name, command, directory="/", user="root", environment=None,
+              numprocs=1, options=None, graceful=False, not_before=None):
         """
         To Start/Set  a program with supervisor
         :params name: The name of the program
@@ -419,20 +1766,71 @@ class Supervisor(object):
         :param directory: The directory
         :param user:
         :param environment:
+        :param numprocs: Number of processes to run the program with
+        :param options: dict of supervisor program options, see SUPERVISOR_OPTIONS
+        :param graceful: When the program is running with the same config,
+                         reload it with HUP instead of a stop/start. ie: gunicorn
+        :param not_before: With graceful, processes started before that
+                           timestamp are restarted anyway
         """
         log_file = "%s/%s.log" % (SUPERVISOR_LOG_DIR, name)
         conf_file = "%s/%s.conf" % (SUPERVISOR_CONF_DIR, name)
-        if cls.status(name) == "RUNNING":
-            cls.ctl("stop", name)
-        with open(conf_file, "wb") as f:
-            f.write(SUPERVISOR_TPL.format(name=name,
-                                          command=command,
-                                          log=log_file,
-                                          directory=directory,
-                                          user=user,
-                                          environment=environment or ""))
-        cls.reload()
-        cls.ctl("start", name)
+        options = cls.get_options(options, name)
+        options.setdefault("numprocs", int(numprocs))
+        if options["numprocs"] < 1:
+            raise ValueError("'numprocs' of '%s' must be at least 1" % name)
+        if options["numprocs"] > 1:
+            options["process_name"] = "%(program_name)s_%(process_num)02d"
+            log_file = "%s/%s_%%(process_num)02d.log" % (SUPERVISOR_LOG_DIR, name)
+        else:
+            del options["numprocs"]
+        if options.get("minfds"):
+            command = "prlimit --nofile=%s:%s %s" % (options["minfds"], options["minfds"], command)
+        if options.get("nice"):
+            command = "nice -n %s %s" % (options["nice"], command)
+        options.pop("minfds", None)
+        options.pop("nice", None)
+        if not options["redirect_stderr"]:
+            options["stderr_logfile"] = log_file
+
+        lines = ["%s=%s" % (k, str(v).lower() if isinstance(v, bool) else v)
+                 for k, v in sorted(options.items())]
+        content = SUPERVISOR_TPL.format(name=name,
+                                        command=command,
+                                        log=log_file,
+                                        directory=directory,
+                                        user=user,
+                                        environment=environment or "",
+                                        options="\n".join(lines) + "\n")
+        if DRY_RUN:
+            write_config(conf_file, content, group="supervisor")
+            return
+
+        # The program restarts for the new code, but supervisor only
+        # rereads its config if it changed
+        changed = write_config(conf_file, content, group="supervisor")
+        running = cls.status(name) == "RUNNING"
+        if graceful and running and not changed:
+            if cls.reload_gracefully(name, not_before=not_before):
+                return
+            _print("==== '%s' didn't reload gracefully, restarting it" % name)
+        with cls._lock:
+            # In a batch, it keeps running until it's committed. When its
+            # config changed, applying it stops the program
+            if cls._batch is not None:
+                if name not in cls._batch:
+                    cls._batch.append(name)
+                if changed:
+                    cls._batch_changed.add(name)
+                    cls._batch_restart.discard(name)
+                elif running:
+                    cls._batch_restart.add(name)
+                return
+        if running:
+            cls.ctl("stop", "%s:*" % name)
+        if changed:
+            cls.reload()
+        cls.ctl("start", "%s:*" % name)
 
     @classmethod
     def stop(cls, name, remove=True):
@@ -442,20 +1840,132 @@ class Supervisor(object):
         :remove: If True will also delete the conf file
         """
         conf_file = "%s/%s.conf" % (SUPERVISOR_CONF_DIR, name)
-        cls.ctl("stop", name)
+        if DRY_RUN:
+            if remove:
+                remove_config(conf_file, group="supervisor")
+            return
+        cls.ctl("stop", "%s:*" % name)
+        changed = False
         if remove:
-            if os.path.isfile(conf_file):
-                os.remove(conf_file)
+            changed = remove_config(conf_file, group="supervisor")
             cls.ctl("remove", name)
-        cls.reload()
+        with cls._lock:
+            if cls._batch is not None:
+                if name in cls._batch:
+                    cls._batch.remove(name)
+                cls._batch_restart.discard(name)
+                if changed:
+                    cls._batch_changed.add(name)
+                return
+        if changed:
+            cls.reload()
+
+    @classmethod
+    @contextlib.contextmanager
+    def batch(cls):
+        """
+        Collect the conf writes and removals of start() and stop(), then
+        reload supervisor once and start the programs in one pass on exit.
+        Nested batches commit with the outermost one.
+
+            with Supervisor.batch():
+                Supervisor.start(...)
+                Supervisor.start(...)
+        """
+        with cls._lock:
+            if cls._batch is None:
+                cls._batch = []
+            cls._batch_depth += 1
+        try:
+            yield
+        finally:
+            # Commit even on error, so programs already stopped are not left down
+            with cls._lock:
+                cls._batch_depth -= 1
+                done = not cls._batch_depth
+            if done:
+                cls.commit()
+
+    @classmethod
+    def pending(cls):
+        """
+        Return the programs waiting for the batch to commit: to be started,
+        or removed
+        """
+        with cls._lock:
+            pending = list(cls._batch or [])
+            return pending + sorted([name for name in cls._batch_changed if name not in pending])
 
     @classmethod
-    def reload(cls):
+    def commit(cls, names=None):
+        """
+        Reload and start the programs pending in the batch, `jobs` at a time.
+        A running program is stopped right before it's started again.
+        The batch stays open if still inside of it
+        :params names: Only commit these programs, ie: the ones of a site.
+                       The others stay pending
+        """
+        with cls._lock:
+            if names is None:
+                pending, changed = cls._batch or [], cls._batch_changed
+                restart = cls._batch_restart
+                cls._batch = [] if cls._batch_depth else None
+                cls._batch_changed = set()
+                cls._batch_restart = set()
+            else:
+                pending = [name for name in cls._batch or [] if name in names]
+                changed = set([name for name in cls._batch_changed if name in names])
+                restart = set([name for name in cls._batch_restart if name in names])
+                if cls._batch is not None:
+                    cls._batch = [name for name in cls._batch if name not in names]
+                cls._batch_changed -= changed
+                cls._batch_restart -= restart
+        if changed:
+            cls.reload(groups=sorted(changed) if names is not None else None)
+
+        def start(name):
+            if name in restart:
+                cls.ctl("stop", "%s:*" % name)
+            cls.ctl("start", "%s:*" % name)
+
+        if cls.jobs > 1 and len(pending) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(cls.jobs, len(pending)))
+            try:
+                pool.map(start, pending)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for name in pending:
+                start(name)
+
+    @classmethod
+    def reload(cls, groups=None):
         """
         Reload supervisor with the changes
+        :params groups: Only apply the changes of these programs. The changes
+                        of the others stay pending until they are applied
         """
-        cls.ctl("reread", "")
-        cls.ctl("update", "")
+        if groups is not None and not groups:
+            return
+        if cls.rpc() is not None:
+            try:
+                result = cls._call("reloadConfig")
+                if result:
+                    added, changed, removed = result[0]
+                    if groups is not None:
+                        added, changed, removed = [[g for g in _ if g in groups]
+                                                   for _ in (added, changed, removed)]
+                    for group in removed + changed:
+                        cls._call("stopProcessGroup", group)
+                        cls._call("removeProcessGroup", group)
+                    for group in changed + added:
+                        cls._call("addProcessGroup", group)
+                return
+            except socket.error:
+                pass
+        run("%s %s %s" % (SUPERVISOR_CTL, "reread", ""))
+        run("%s %s %s" % (SUPERVISOR_CTL, "update", " ".join(groups or [])))
 
     @classmethod
     def restart(cls):
@@ -464,6 +1974,213 @@ class Supervisor(object):
         """
         cls.ctl("restart", "all")
 
+class DeployStep(object):
+    """
+    A step of a DeployGraph. The processes it runs through run() and
+    runvenv() are tracked, so they can be stopped
+    """
+    def __init__(self, name, func, requires=None, timeout=None):
+        self.name = name
+        self.func = func
+        self.requires = requires or []
+        self.timeout = timeout
+        self.state = "PENDING"  # RUNNING, DONE, FAILED or CANCELLED
+        self.error = None
+        self.started = None
+        self.duration = None
+        self.processes = []
+        self._lock = threading.Lock()
+
+    def popen(self, args, **kwargs):
+        """
+        Start a process in its own process group, so its children are
+        stopped with it
+        """
+        kwargs["preexec_fn"] = os.setsid
+        process = subprocess.Popen(args, **kwargs)
+        with self._lock:
+            self.processes.append(process)
+            stopped = self.state != "RUNNING"
+        if stopped:  # Timed out or cancelled while starting it
+            self.kill()
+        return process
+
+    def kill(self):
+        """
+        Stop the processes of the step that are still running
+        """
+        with self._lock:
+            processes = list(self.processes)
+        for process in processes:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+class DeployGraph(object):
+    """
+    A deployment as a graph of steps. A step starts once the steps it
+    requires are done, `jobs` steps at a time, so a deployment takes as long
+    as its longest chain of steps, not as the sum of them.
+    The steps it requires must be added before a step, so there can't be
+    a cycle. When a step fails or times out, the steps not started yet are
+    cancelled, the running ones finish, then it raises. The processes of a
+    step that times out are stopped, and its thread is waited for.
+    The output of each step is prefixed with its name
+
+        graph = DeployGraph(jobs=4)
+        graph.add("virtualenv", app.setup_virtualenv)
+        graph.add("requirements", app.install_requirements, requires=["virtualenv"])
+        graph.add("static", static)
+        graph.run()
+    """
+    def __init__(self, jobs=DEPLOY_JOBS, timeout=DEPLOY_STEP_TIMEOUT):
+        """
+        :params jobs: Number of steps run concurrently
+        :params timeout: Default seconds a step may run before its
+                         processes are stopped and it fails
+        """
+        self.jobs = max(1, int(jobs))
+        self.timeout = timeout
+        self.steps = []
+        self.duration = None
+        self._steps = {}
+        self._threads = []
+        self._cond = threading.Condition()
+
+    def __contains__(self, name):
+        return name in self._steps
+
+    def add(self, name, func, requires=None, timeout=None):
+        """
+        Add a step
+        :params name: The name of the step, unique
+        :params func: The callable to run
+        :params requires: The names of the steps to run before. None are skipped
+        :params timeout: Seconds it may run, the graph timeout by default
+        :returns str: The name
+        """
+        if name in self._steps:
+            raise ValueError("Deploy step '%s' is already added" % name)
+        requires = [r for r in requires or [] if r]
+        for required in requires:
+            if required not in self._steps:
+                raise ValueError("Deploy step '%s' requires '%s', which must be added "
+                                 "before it" % (name, required))
+        step = DeployStep(name, func, requires, timeout or self.timeout)
+        self.steps.append(step)
+        self._steps[name] = step
+        return name
+
+    def _run_step(self, step):
+        _step_context.step = step
+        try:
+            step.func()
+            error = None
+        except Exception as ex:
+            error = ex
+            _print("FAILED: %s" % ex)
+        finally:
+            _step_context.step = None
+        with self._cond:
+            if step.state == "RUNNING":  # Not timed out meanwhile
+                step.state = "FAILED" if error else "DONE"
+                step.error = error
+                step.duration = time.time() - step.started
+            self._cond.notify()
+
+    def _stop(self, step, error):
+        """
+        Fail a running step, and stop its processes. Its thread can't be
+        stopped, run() waits for it to end
+        """
+        with step._lock:
+            step.state = "FAILED"
+            step.error = error
+            step.duration = time.time() - step.started
+        _print("==== Step '%s' failed: %s" % (step.name, error))
+        step.kill()
+
+    def run(self):
+        """
+        Run the steps
+        :returns float: Seconds it took
+        """
+        started = time.time()
+        pending = list(self.steps)
+        running = []
+        try:
+            with self._cond:
+                while pending or running:
+                    now = time.time()
+                    for step in list(running):
+                        if step.state != "RUNNING":
+                            running.remove(step)
+                        elif step.timeout and now - step.started > step.timeout:
+                            self._stop(step, "timed out after %ss" % step.timeout)
+                            running.remove(step)
+
+                    if any([step.state == "FAILED" for step in self.steps]):
+                        for step in pending:
+                            step.state = "CANCELLED"
+                        pending = []
+
+                    for step in list(pending):
+                        if len(running) >= self.jobs:
+                            break
+                        if all([self._steps[r].state == "DONE" for r in step.requires]):
+                            pending.remove(step)
+                            step.state = "RUNNING"
+                            step.started = now
+                            thread = threading.Thread(target=self._run_step, args=(step,))
+                            thread.daemon = True
+                            running.append(step)
+                            self._threads.append((step, thread))
+                            thread.start()
+                    if running:
+                        self._cond.wait(0.2)
+            # A step that timed out may still be running, ie: a Python loop
+            self._join()
+        except KeyboardInterrupt:
+            for step in pending:
+                step.state = "CANCELLED"
+            for step in running:
+                self._stop(step, "interrupted")
+            self._join()
+            raise
+        finally:
+            self.duration = time.time() - started
+
+        failed = [step for step in self.steps if step.state == "FAILED"]
+        if failed:
+            cancelled = [step.name for step in self.steps if step.state == "CANCELLED"]
+            raise Exception("Deploy step %s. Cancelled: %s" % (
+                ", ".join(["'%s' failed: %s" % (step.name, step.error) for step in failed]),
+                ", ".join(cancelled) or "none"))
+        return self.duration
+
+    def _join(self):
+        """
+        Wait for the threads of the steps to end
+        """
+        for step, thread in self._threads:
+            if thread.is_alive():
+                _print("==== Waiting for step '%s' to stop ..." % step.name)
+                thread.join()
+
+    def print_summary(self, duration=None):
+        """
+        Print the duration of each step, and of the whole graph
+        :params duration: Seconds the graph took, the last run() by default
+        """
+        duration = self.duration if duration is None else duration
+        _print("==== Deploy steps:")
+        for step in self.steps:
+            _print("\t %-40s %6.1fs  %s" % (step.name, step.duration or 0, step.state))
+        _print("==== Took %.1fs for %.1fs of steps, %s at a time"
+               % (duration or 0, sum([step.duration or 0 for step in self.steps]), self.jobs))
+
 class Git(object):
     def __init__(self, directory):
         self.directory = directory
@@ -487,7 +2204,139 @@ class Git(object):
             return True
         return False
 
-    def update_post_receive_hook(self, repo, command=""):
+    def get_releases(self, repo):
+        """
+        Return the releases of a repo, newest first, in the order they were
+        created. The mtime of a release changes with the files written in it.
+        Releases missing from the order file are older, by mtime
+        """
+        releases_dir = os.path.join(repo, RELEASES_DIRECTORY)
+        if not os.path.isdir(releases_dir):
+            return []
+        order = [r for r in self.get_releases_order(releases_dir)
+                 if os.path.isdir(os.path.join(releases_dir, r))]
+        others = [os.path.join(releases_dir, r) for r in os.listdir(releases_dir)
+                  if not r.endswith(".tmp") and r not in order]
+        others = sorted([r for r in others if os.path.isdir(r)],
+                        key=lambda r: os.stat(r).st_mtime, reverse=True)
+        return [os.path.join(releases_dir, r) for r in reversed(order)] + others
+
+    def get_releases_order(self, releases_dir):
+        """
+        Return the release names of the order file, from the oldest to the newest
+        """
+        order_file = os.path.join(releases_dir, RELEASES_ORDER_FILE)
+        if not os.path.isfile(order_file):
+            return []
+        with open(order_file) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def add_release_order(self, releases_dir, name):
+        """
+        Record a release as the newest one in the order file. The releases
+        that were removed are dropped from it
+        """
+        order = [r for r in self.get_releases_order(releases_dir)
+                 if r != name and os.path.isdir(os.path.join(releases_dir, r))]
+        order_file = os.path.join(releases_dir, RELEASES_ORDER_FILE)
+        tmp_file = "%s.%s.tmp" % (order_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(order + [name]) + "\n")
+        os.rename(tmp_file, order_file)
+
+    def get_current_release(self, repo):
+        current = os.path.join(repo, RELEASES_CURRENT)
+        if os.path.islink(current):
+            return os.path.join(repo, os.readlink(current))
+        return None
+
+    def create_release(self, repo, rev, git_dir=None):
+        """
+        Check out a commit in <repo>/releases/<commit>. The files that didn't
+        change since the live release are hard links to it
+        :params repo: The working directory
+        :params rev: The commit
+        :params git_dir: The bare repo
+        :returns str: The release directory
+        """
+        working_dir, bare_repo = self.get_working_dir(repo)
+        releases_dir = os.path.join(working_dir, RELEASES_DIRECTORY)
+        release = os.path.join(releases_dir, rev)
+        if os.path.isdir(release):
+            self.add_release_order(releases_dir, rev)
+            return release
+
+        tmp_dir = release + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        archive = subprocess.call("git --git-dir=%s archive %s | tar -x -C %s"
+                                  % (git_dir or bare_repo, rev, tmp_dir), shell=True)
+        if archive != 0:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise Exception("Can't check out '%s' from %s" % (rev, git_dir or bare_repo))
+
+        current = self.get_current_release(working_dir)
+        if current and os.path.isdir(current):
+            for root, dirs, files in os.walk(tmp_dir):
+                for name in files:
+                    new_file = os.path.join(root, name)
+                    old_file = os.path.join(current, os.path.relpath(new_file, tmp_dir))
+                    if os.path.islink(new_file) or os.path.islink(old_file) \
+                            or not os.path.isfile(old_file):
+                        continue
+                    new_stat, old_stat = os.stat(new_file), os.stat(old_file)
+                    if new_stat.st_size != old_stat.st_size or new_stat.st_mode != old_stat.st_mode:
+                        continue
+                    if filecmp.cmp(new_file, old_file, shallow=False):
+                        os.link(old_file, new_file + ".propel-link")
+                        os.rename(new_file + ".propel-link", new_file)
+
+        os.rename(tmp_dir, release)
+        self.add_release_order(releases_dir, rev)
+        return release
+
+    def switch_release(self, repo, release):
+        """
+        Point <repo>/current to a release, atomically
+        """
+        current = os.path.join(repo, RELEASES_CURRENT)
+        tmp_link = "%s.%s.tmp" % (current, os.getpid())
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(release, repo), tmp_link)
+        os.rename(tmp_link, current)
+
+    def collect_releases(self, repo, keep=RELEASES_KEEP):
+        """
+        Remove the oldest releases, but the live one
+        :returns list: The removed releases
+        """
+        current = self.get_current_release(repo)
+        releases = [r for r in self.get_releases(repo)
+                    if not current or os.path.realpath(r) != os.path.realpath(current)]
+        for release in releases[keep:]:
+            shutil.rmtree(release, ignore_errors=True)
+        return releases[keep:]
+
+    def rollback(self, repo, steps=1):
+        """
+        Switch <repo>/current to the release `steps` older than the live one
+        :returns str: The release
+        """
+        releases = self.get_releases(repo)
+        current = self.get_current_release(repo)
+        paths = [os.path.realpath(r) for r in releases]
+        if not current or os.path.realpath(current) not in paths:
+            raise Exception("No live release in %s" % repo)
+        index = paths.index(os.path.realpath(current)) + steps
+        if steps < 1 or index >= len(releases):
+            raise Exception("There are only %s release(s) older than the live one"
+                            % (len(releases) - paths.index(os.path.realpath(current)) - 1))
+        self.switch_release(repo, releases[index])
+        return releases[index]
+
+    def update_post_receive_hook(self, repo, command="", branch=GIT_DEFAULT_BRANCH,
+                                 releases=0):
         working_dir, bare_repo = self.get_working_dir(repo)
         post_receice_hook_file = "%s/hooks/post-receive" % bare_repo
 
@@ -498,8 +2347,9 @@ class Git(object):
             shutil.copyfile(post_receice_hook_file, backup_file)
 
         with open(post_receice_hook_file, "wb") as f:
-            content = Template(POST_RECEIVE_HOOK_CONFIG)\
-                .render(WORKING_DIR=working_dir, COMMAND=command)
+            content = get_template("post-receive")\
+                .render(WORKING_DIR=working_dir, COMMAND=command, BRANCH=branch,
+                        RELEASES=releases)
             f.write(content)
         run("chmod +x %s " % post_receice_hook_file)
 
@@ -507,21 +2357,495 @@ class App(object):
     virtualenv = None
     directory = None
     deployed_info = []
+    deployed_workers = []
+    autotune_plan = {}
 
     def __init__(self, directory):
         self.config = get_deploy_config(directory)
         self.directory = directory
         self.virtualenv = self.config["virtualenv"] if "virtualenv" in self.config else {}
 
+    def batch(self):
+        """
+        Context manager to apply all the Supervisor changes of a deployment at once
+            with app.batch():
+                app.deploy_web()
+        """
+        return Supervisor.batch()
+
     def get_web_by_name(self, name):
         if "web" in self.config:
             for _ in self.config["web"]:
                 if _.get("name") == name:
                     return _
 
-    def publish_web(self, name=None, undeploy=False, maintenance=False, site=None):
+    def get_web_programs(self, name):
+        """
+        Return the blue/green supervisor program names of a site.
+        The blue one keeps the legacy name, so existing deployments are picked up
+        :returns tuple: (blue, green)
+        """
+        blue = "propel-web__%s" % name
+        return blue, "%s__green" % blue
+
+    def get_live_web_program(self, name):
+        """
+        Return the supervisor program name currently serving the site, or None
+        """
+        for program in self.get_web_programs(name):
+            if Supervisor.status(program) == "RUNNING":
+                return program
+        return None
+
+    def get_web_instances(self, program, instances=1):
+        """
+        Return the supervisor program names of the gunicorn instances of a web program
+        :params program: The web program, ie: propel-web__mysite.com
+        :params instances: Number of instances
+        """
+        return [program] + ["%s__%s" % (program, i) for i in range(1, instances)]
+
+    def get_deployed_web_instances(self, program):
+        """
+        Return the program names of the instances of a web program that have a
+        supervisor conf file
+        """
+        if not os.path.isdir(SUPERVISOR_CONF_DIR):
+            return []
+        pattern = re.compile(r"^%s(__\d+)?\.conf$" % re.escape(program))
+        return sorted([f[:-5] for f in os.listdir(SUPERVISOR_CONF_DIR) if pattern.match(f)])
+
+    def get_static_options(self, site):
+        """
+        Return the `nginx.static` options of a site, with the defaults filled in.
+        `static: True` uses the defaults, no `static` turns them off
+        """
+        static = site.get("nginx", {}).get("static", False)
+        if not static:
+            return {}
+        options = dict(NGINX_STATIC_DEFAULTS)
+        if isinstance(static, dict):
+            options.update(static)
+        return options
+
+    def get_cache_options(self, site):
+        """
+        Return the `nginx.cache` options of a site, with the defaults filled in.
+        `valid` can be a single TTL, used for 200, 301 and 302. `bypass` holds
+        the variables of proxy_cache_bypass/proxy_no_cache: the Authorization
+        header, and the `bypass_cookies` or any cookie when they are not set
+        """
+        cache = site.get("nginx", {}).get("cache", False)
+        if not cache or not site.get("application"):
+            return {}
+        options = dict(NGINX_CACHE_DEFAULTS)
+        if isinstance(cache, dict):
+            options.update(cache)
+        if not isinstance(options["valid"], dict):
+            options["valid"] = {"200 301 302": options["valid"]}
+        zone = re.sub(r"[^\w]", "_", site["name"])
+        options["zone"] = "propel_%s" % zone
+        options["path"] = os.path.join(NGINX_CACHE_DIRECTORY, zone)
+        bypass = ["$http_authorization"]
+        if options["bypass_cookies"] is None:
+            bypass.append("$http_cookie")
+        else:
+            bypass.extend(["$cookie_%s" % cookie for cookie in options["bypass_cookies"]])
+        options["bypass"] = " ".join(bypass)
+        return options
+
+    def get_healthcheck_options(self, site):
+        """
+        Return the `healthcheck` options of a Python site, with the defaults
+        filled in. `healthcheck: True` uses the defaults, a string is the path.
+        It requires `zero_downtime`: without a previous gunicorn left running,
+        a failing site would have nothing to fall back to
+        """
+        healthcheck = site.get("healthcheck", False)
+        if not healthcheck or not site.get("application"):
+            return {}
+        if not site.get("zero_downtime"):
+            raise ValueError("Site '%s' healthcheck requires zero_downtime" % site["name"])
+        options = dict(HEALTHCHECK_DEFAULTS)
+        if isinstance(healthcheck, dict):
+            options.update(healthcheck)
+        elif not isinstance(healthcheck, bool):
+            options["path"] = healthcheck
+        if not str(options["path"]).startswith("/"):
+            raise ValueError("Site '%s' healthcheck path must start with '/'" % site["name"])
+        if not options["host"]:
+            server_name = str(site.get("nginx", {}).get("server_name", site["name"])).split()
+            # Wildcards and regexes can't be sent as Host
+            if server_name and re.match(r"^[\w.-]+$", server_name[0]):
+                options["host"] = server_name[0]
+        return options
+
+    def get_access_log_options(self, site):
+        """
+        Return the `nginx.access_log` options of a site: buffering, and the
+        percent of requests to log
+        """
+        options = site.get("nginx", {}).get("access_log", {})
+        if not options:
+            return {}
+        params = ["combined"]
+        if options.get("buffer"):
+            params.append("buffer=%s" % options["buffer"])
+        if options.get("flush"):
+            params.append("flush=%s" % options["flush"])
+        sample = options.get("sample")
+        var = "propel_log_%s" % re.sub(r"[^\w]", "_", site["name"])
+        if sample is not None:
+            if isinstance(sample, bool) or not isinstance(sample, (int, float)) \
+                    or not 0 < sample <= 100:
+                raise ValueError("Site '%s' access_log sample must be a percent, "
+                                 "between 0 and 100" % site["name"])
+            if sample < 100:
+                params.append("if=$%s" % var)
+            else:
+                sample = None
+        return {"params": " ".join(params), "sample": sample, "var": var}
+
+    def get_logs_dirs(self):
+        """
+        Return the nginx logs directories of the sites
+        """
+        logs_dirs = set()
+        for site in self.config.get("web", []):
+            if "name" in site and not site.get("exclude") and not site.get("remove"):
+                logs_dirs.add(site.get("nginx", {}).get("logs_dir") or "%s.logs" % self.directory)
+        return sorted(logs_dirs)
+
+    def get_logrotate_conf_file(self):
+        return LOGROTATE_CONF_FILE % re.sub(r"[^\w.-]", "_", self.directory.strip("/"))
+
+    def setup_logrotate(self, undeploy=False):
+        """
+        Write the logrotate config of the nginx logs of the app
+        :params undeploy: Remove it instead
+        :returns str: The logrotate config file, if any
+        """
+        conf_file = self.get_logrotate_conf_file()
+        logs_dirs = self.get_logs_dirs()
+        if undeploy or not logs_dirs:
+            remove_config(conf_file, group="logrotate")
+            return None
+        options = dict(LOGROTATE_DEFAULTS)
+        options.update(self.config.get("logs", {}))
+        if options["frequency"] not in ("daily", "weekly", "monthly"):
+            raise ValueError("logs frequency must be daily, weekly or monthly")
+        content = get_template("logrotate").render(LOGS_DIRS=logs_dirs,
+                                                   FREQUENCY=options["frequency"],
+                                                   ROTATE=int(options["rotate"]),
+                                                   MAXSIZE=options["maxsize"],
+                                                   COMPRESS=options["compress"],
+                                                   NGINX_BIN=NGINX_BIN)
+        write_config(conf_file, content, group="logrotate")
+        return conf_file
+
+    def measure_worker_memory(self, name):
+        """
+        Return the average resident memory of the running gunicorn workers of
+        a site, None if it has none
+        """
+        rss = []
+        for slot in self.get_web_programs(name):
+            for program in self.get_deployed_web_instances(slot):
+                for pid in Supervisor.pids(program):
+                    rss.extend([get_process_rss(child) for child in get_process_children(pid)])
+        rss = [r for r in rss if r]
+        return sum(rss) // len(rss) if rss else None
+
+    def get_autotune_plan(self):
+        """
+        With `autotune`, share the cpus and the memory of the host between
+        the Python sites by their `weight`, instead of giving each site
+        (cpus * 2) + 1 workers. Each instance gets a worker, then the rest of
+        the (cpus * 2) + 1 workers are shared by weight. A site is reduced to
+        what its share of the memory can hold, using the measured memory of
+        its running workers. When memory takes workers off a sync or gthread
+        site, they are made up with threads. gevent and the other async
+        workers ignore threads. When the host can't hold a worker per
+        instance, each instance still gets one, with a warning.
+        The plan is kept for publish_web
+        :returns dict: site name: {workers, threads, worker_class, instances,
+                                   worker_memory, measured, warning}
+        """
+        options = self.config.get("autotune")
+        if not options:
+            return {}
+        options = options if isinstance(options, dict) else {}
+        sites = [site for site in self.config.get("web", [])
+                 if site.get("application") and not site.get("exclude") and not site.get("remove")]
+        if not sites:
+            return {}
+        for site in sites:
+            if float(site.get("weight", 1)) <= 0:
+                raise ValueError("Site '%s' weight must be positive" % site["name"])
+
+        cpus, memory = get_host_resources()
+        reserve = float(options.get("memory_reserve", AUTOTUNE_MEMORY_RESERVE))
+        default_worker_memory = parse_size(options.get("worker_memory", GUNICORN_WORKER_MEMORY))
+        cpu_workers = (cpus * 2) + 1
+        total_weight = sum([float(site.get("weight", 1)) for site in sites])
+
+        # A worker per instance, then the rest by weight. What flooring leaves
+        # goes to the sites with the largest fractions
+        minimums = dict([(site["name"], int(site.get("instances", 1))) for site in sites])
+        remainder = max(0, cpu_workers - sum(minimums.values()))
+        shares = dict([(site["name"], remainder * float(site.get("weight", 1)) / total_weight)
+                       for site in sites])
+        cpu_shares = dict([(name, minimums[name] + int(share)) for name, share in shares.items()])
+        leftover = remainder - sum([int(share) for share in shares.values()])
+        for name in sorted(shares, key=lambda n: shares[n] - int(shares[n]), reverse=True)[:leftover]:
+            cpu_shares[name] += 1
+        oversubscribed = sum(minimums.values()) > cpu_workers
+
+        plan = {}
+        for site in sites:
+            name = site["name"]
+            share = float(site.get("weight", 1)) / total_weight
+            instances = minimums[name]
+            worker_memory = self.measure_worker_memory(name)
+            measured = worker_memory is not None
+            worker_memory = worker_memory or default_worker_memory
+            warning = None
+            if oversubscribed:
+                warning = "the host holds %s worker(s) for %s instance(s), it's oversubscribed" \
+                          % (cpu_workers, sum(minimums.values()))
+
+            workers = cpu_shares[name]
+            if memory:
+                memory_workers = int(memory * (1 - reserve) * share / worker_memory)
+                if memory_workers < instances:
+                    warning = "its share of the memory holds %s worker(s), for %s instance(s)" \
+                              % (memory_workers, instances)
+                workers = min(workers, max(instances, memory_workers))
+            reduced = workers < cpu_shares[name]
+            workers //= instances
+
+            worker_class = site.get("gunicorn", {}).get("worker-class",
+                                                        GUNICORN_DEFAULT_WORKER_CLASS)
+            threads = 1 if worker_class == "sync" else GUNICORN_DEFAULT_THREADS
+            if reduced and worker_class in ("sync", "gthread"):
+                ratio = -(-cpu_shares[name] // (workers * instances))  # Rounded up
+                threads = min(GUNICORN_MAX_THREADS, threads * ratio)
+            plan[name] = {"workers": workers,
+                          "threads": threads,
+                          "worker_class": worker_class,
+                          "instances": instances,
+                          "worker_memory": worker_memory,
+                          "measured": measured,
+                          "warning": warning}
+        self.autotune_plan = plan
+        return plan
+
+    def precompress_web(self, site):
+        """
+        Precompress the static files of the aliases of a site, with `static.precompress`
+        """
+        static = self.get_static_options(site)
+        if static.get("precompress") and not DRY_RUN:
+            for location in site.get("nginx", {}).get("aliases", {}).values():
+                path = location if location.startswith("/") \
+                    else os.path.join(self.directory, location)
+                if os.path.isdir(path):
+                    precompress_static(path, use_brotli=static.get("brotli_static"))
+
+    def get_push_changes(self, oldrev, newrev, git_dir):
+        """
+        Tell what a git push changed, to only run the stages it needs
+        :params oldrev: The previous commit
+        :params newrev: The pushed commit
+        :params git_dir: The bare repo
+        :returns dict:
+            full: (bool) Everything must be deployed, ie: first push, virtualenv changed
+            requirements: (bool) requirements*.txt changed
+            sites: (set) Sites whose config changed in propel.yml
+            code: (bool) Code changed, the Python sites and the workers must reload
+            static: (list) Changed files served by nginx only: under an alias,
+                    or under the root_dir of a site without an application
+            files: (list) All the changed files
+        """
+        changes = {"full": False, "requirements": False, "sites": set(),
+                   "code": False, "static": [], "files": []}
+        if not oldrev or not newrev or not git_dir or not oldrev.strip("0"):
+            changes["full"] = True
+            return changes
+
+        git = "git --git-dir=%s" % git_dir
+        diff = subprocess.Popen("%s diff --name-only %s %s" % (git, oldrev, newrev), shell=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = diff.communicate()[0]
+        if diff.returncode != 0:  # ie: a forced push with an unknown oldrev
+            changes["full"] = True
+            return changes
+        if isinstance(output, bytes):
+            output = output.decode("utf-8")
+        changes["files"] = [f for f in output.split("\n") if f]
+
+        # propel.yml, by section
+        if DEPLOY_CONFIG_FILE in changes["files"]:
+            old_config = run("%s show %s:%s" % (git, oldrev, DEPLOY_CONFIG_FILE), verbose=False)
+            try:
+                old_config = yaml.load(old_config) or {}
+            except yaml.YAMLError:
+                old_config = {}
+            for section in set(list(old_config) + list(self.config)):
+                if section in ("web", "scripts"):
+                    continue
+                if old_config.get(section) != self.config.get(section):
+                    changes["full"] = True
+            old_sites = dict([(site.get("name"), site) for site in old_config.get("web", [])])
+            for site in self.config.get("web", []):
+                if old_sites.pop(site.get("name"), None) != site:
+                    changes["sites"].add(site.get("name"))
+
+        # Static files are under an alias of a site, or served by nginx for a PHP/HTML site.
+        # A PHP/HTML site at the root of the repo only makes it all static without Python sites
+        has_application = any([site.get("application") for site in self.config.get("web", [])])
+        static_dirs = []
+        for site in self.config.get("web", []):
+            nginx = site.get("nginx", {})
+            locations = list(nginx.get("aliases", {}).values())
+            if not site.get("application"):
+                locations.append(nginx.get("root_dir") or "")
+            for location in locations:
+                if not location.startswith("/"):
+                    location = os.path.normpath(location).strip("/")
+                    if location != ".":
+                        static_dirs.append(location + "/")
+                    elif not has_application:
+                        static_dirs.append("")
+        for f in changes["files"]:
+            if f == DEPLOY_CONFIG_FILE:
+                continue
+            if re.match(r"^requirements.*\.txt$", os.path.basename(f)):
+                changes["requirements"] = True
+            elif any([f.startswith(static_dir) for static_dir in static_dirs]):
+                changes["static"].append(f)
+            else:
+                changes["code"] = True
+        return changes
+
+    def reload_webs(self, names=None):
+        """
+        Gracefully reload the gunicorn of the Python sites, with HUP.
+        The workers are replaced after they finish their requests. It waits
+        for the new workers, so the health checks probe the new code.
+        The instances are reloaded concurrently, `Supervisor.jobs` at a time
+        :params names: The sites, all of them by default
+        """
+        instances = []
+        for site in self.config.get("web", []):
+            if not site.get("application") or site.get("exclude") or site.get("remove"):
+                continue
+            if names is not None and site["name"] not in names:
+                continue
+            program = self.get_live_web_program(site["name"])
+            instances.extend(self.get_deployed_web_instances(program) if program else [])
+
+        def reload(instance):
+            if not Supervisor.reload_gracefully(instance):
+                _print("==== '%s' didn't reload gracefully" % instance)
+
+        if Supervisor.jobs > 1 and len(instances) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(Supervisor.jobs, len(instances)))
+            try:
+                pool.map(reload, instances)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for instance in instances:
+                reload(instance)
+
+    def get_web_backends(self, site, program=None):
+        """
+        Return the addresses of the deployed gunicorn instances of a site
+        :params program: The web program, the live one by default
+        """
+        name = site["name"]
+        program = program or self.get_live_web_program(name) or self.get_web_programs(name)[0]
+        backends = []
+        for instance in self.get_deployed_web_instances(program):
+            if site.get("bind", "tcp") == "unix":
+                backends.append("unix:%s" % self.get_web_socket(instance,
+                                                                site.get("user", "root")))
+            else:
+                port = PortRegistry().get(instance)
+                if port:
+                    backends.append("127.0.0.1:%s" % port)
+        return backends
+
+    def check_web(self, site, backends=None, boot_timeout=GUNICORN_BOOT_TIMEOUT):
+        """
+        Run the health check of a site against its gunicorn instances
+        :params backends: The addresses to probe, the deployed ones by default
+        :params boot_timeout: Seconds to wait for each to accept connections first
+        :returns str: The error, or None if healthy or without health check
+        """
+        options = self.get_healthcheck_options(site)
+        if not options or DRY_RUN:
+            return None
+        if backends is None:
+            backends = self.get_web_backends(site)
+        if not backends:
+            return "no gunicorn instance deployed"
+        failures = check_backends(backends, options, boot_timeout)
+        if failures:
+            return "GET %s failed on %s" % (options["path"], ", ".join(
+                ["%s (%s)" % failure for failure in failures]))
+        return None
+
+    def check_webs(self, names=None):
+        """
+        Run the health checks of the running sites, ie: after a graceful
+        reload or a rollback. It only reports: a reloaded gunicorn has no
+        previous one to fall back to. Deploys are gated when the zero
+        downtime sites are published, see publish_web
+        :params names: The sites, all of them by default
+        :returns list: The (name, error) of the sites that failed
+        """
+        failed = dict([(i[0], i[3]) for i in self.deployed_info if i[3]])
+        results = []
+        for site in self.config.get("web", []):
+            name = site.get("name")
+            if site.get("exclude") or site.get("remove") \
+                    or name in failed or (names is not None and name not in names):
+                continue
+            error = self.check_web(site)
+            if error:
+                _print("==== Site '%s' failed its health check: %s" % (name, error))
+                self.deployed_info = [(i[0], None, None, "Health check: %s" % error)
+                                      if i[0] == name else i for i in self.deployed_info]
+                results.append((name, error))
+        return results
+
+    def restart_workers(self):
         """
+        Restart the running workers of the app
+        """
+        for workers in self.config.get("workers", {}).values():
+            for worker in workers:
+                name = "propel-worker__%s" % worker.get("name")
+                if Supervisor.status(name) == "RUNNING":
+                    Supervisor.ctl("stop", "%s:*" % name)
+                    Supervisor.ctl("start", "%s:*" % name)
 
+    def get_web_socket(self, program, user="root"):
+        """
+        Return the unix socket path of a web supervisor program
+        :params user: The site user, whose socket directory it's in
+        """
+        return "%s/%s.sock" % (get_socket_dir(user), program.replace("propel-web__", "", 1))
+
+    def publish_web(self, name=None, undeploy=False, maintenance=False, site=None,
+                    precompress=True):
+        """
+
+        :params precompress: Compress the static files of the site. False
+                             when precompress_web() runs as its own step
         """
 
         # Maintenance
@@ -549,30 +2873,70 @@ class App(object):
         user = site.get("user", "root")
         remove = site.get("remove", False)
         exclude = site.get("exclude", False)
+        zero_downtime = site.get("zero_downtime", False)
+        zero_downtime_options = zero_downtime if isinstance(zero_downtime, dict) else {}
+        bind = site.get("bind", "tcp")
+        supervisor_options = site.get("supervisor", {})
+        reload_mode = site.get("reload", "hup")
+        upstream = nginx.get("upstream", {})
+        static = self.get_static_options(site)
+        cache = self.get_cache_options(site)
+        access_log = self.get_access_log_options(site)
         gunicorn_app_name = "propel-web__%s" % name
+        live_app_name = None
         nginx_config_file = get_domain_conf_file(name)
-        proxy_port = None
+        backends = []
 
         # Exclude from re/deploying
         if exclude:
             return
 
         if remove or undeploy:
-            if os.path.isfile(nginx_config_file):
-                os.remove(nginx_config_file)
+            Nginx.remove(nginx_config_file)
+            if cache and not DRY_RUN:
+                shutil.rmtree(cache["path"], ignore_errors=True)
             if application:
-                Supervisor.stop(name=gunicorn_app_name, remove=True)
+                for slot in self.get_web_programs(name):
+                    for program in self.get_deployed_web_instances(slot) or [slot]:
+                        Supervisor.stop(name=program, remove=True)
+                        PortRegistry().release(program)
             return
 
         # Python app will use Gunicorn+Gevent and Supervisor
         if application:
-            proxy_port = generate_random_port()
+            # Blue/Green: start the new gunicorn next to the live one
+            if zero_downtime:
+                blue, green = self.get_web_programs(name)
+                live_app_name = self.get_live_web_program(name)
+                gunicorn_app_name = blue if live_app_name == green else green
+
+            if bind not in ("tcp", "unix"):
+                raise ValueError("Site '%s' bind must be 'tcp' or 'unix'" % name)
+            # Processes of a program would share its port, instances have their own
+            if Supervisor.get_options(supervisor_options, name).get("numprocs", 1) > 1:
+                raise ValueError("Site '%s' can't use supervisor 'numprocs', "
+                                 "use 'instances' instead" % name)
+            if bind == "unix" and not DRY_RUN:
+                setup_socket_dir(user)
+            if reload_mode not in ("hup", "restart"):
+                raise ValueError("Site '%s' reload must be 'hup' or 'restart'" % name)
+            self.get_healthcheck_options(site)  # Validated before anything starts
+            # A gunicorn started before its virtualenv was rebuilt runs the
+            # previous one, HUP would keep it
+            virtualenv_path = os.path.join(VIRTUALENV_DIRECTORY, self.virtualenv.get("name"))
+            virtualenv_time = os.lstat(virtualenv_path).st_mtime \
+                if os.path.lexists(virtualenv_path) else None
+
             default_gunicorn = {
                 "workers": (multiprocessing.cpu_count() * 2) + 1,
                 "threads": GUNICORN_DEFAULT_THREADS,
                 "max-requests": GUNICORN_DEFAULT_MAX_REQUESTS,
                 "worker-class": GUNICORN_DEFAULT_WORKER_CLASS
             }
+            # Autotune shares the host between the sites, per instance
+            if name in self.autotune_plan:
+                default_gunicorn["workers"] = self.autotune_plan[name]["workers"]
+                default_gunicorn["threads"] = self.autotune_plan[name]["threads"]
             [gunicorn_options.setdefault(k, v) for k, v in
              default_gunicorn.items()]
             settings = " ".join(["--%s %s" % (x[0], x[1]) for x in
@@ -580,49 +2944,134 @@ class App(object):
             gunicorn_bin = get_venv_bin(bin_program="gunicorn",
                                         virtualenv=self.virtualenv.get("name"))
 
-            command = "{GUNICORN_BIN} -b 0.0.0.0:{PROXY_PORT} {APP} {SETTINGS}" \
-                .format(GUNICORN_BIN=gunicorn_bin,
-                        PROXY_PORT=proxy_port,
-                        APP=application,
-                        SETTINGS=settings, )
-
-            Supervisor.start(name=gunicorn_app_name,
-                             command=command,
-                             directory=directory,
-                             user=user,
-                             environment=environment)
+            # Each gunicorn instance is its own program, and an upstream backend
+            weights = upstream.get("weights", [])
+            programs = self.get_web_instances(gunicorn_app_name, int(site.get("instances", 1)))
+            for i, program in enumerate(programs):
+                if bind == "unix":
+                    proxy_socket = self.get_web_socket(program, user)
+                    PortRegistry().release(program)
+                    gunicorn_bind = backend = "unix:%s" % proxy_socket
+                else:
+                    proxy_port = PortRegistry().allocate(program)
+                    gunicorn_bind = "0.0.0.0:%s" % proxy_port
+                    backend = "127.0.0.1:%s" % proxy_port
+                backends.append({"address": backend,
+                                 "weight": weights[i] if i < len(weights) else None})
+
+                # --chdir: gunicorn goes back to the directory on HUP, so a
+                # switched `current` release is picked up
+                command = "{GUNICORN_BIN} --chdir {DIRECTORY} -b {BIND} {APP} {SETTINGS}" \
+                    .format(GUNICORN_BIN=gunicorn_bin,
+                            DIRECTORY=directory,
+                            BIND=gunicorn_bind,
+                            APP=application,
+                            SETTINGS=settings, )
+
+                Supervisor.start(name=program,
+                                 command=command,
+                                 directory=directory,
+                                 user=user,
+                                 environment=environment,
+                                 options=supervisor_options,
+                                 graceful=reload_mode == "hup",
+                                 not_before=virtualenv_time)
+
+            # Instances left over from a deployment with more of them
+            for program in self.get_deployed_web_instances(gunicorn_app_name):
+                if program not in programs:
+                    Supervisor.stop(name=program, remove=True)
+                    PortRegistry().release(program)
+
+            if zero_downtime and not DRY_RUN:
+                Supervisor.commit(programs)
+                timeout = zero_downtime_options.get("timeout", GUNICORN_BOOT_TIMEOUT)
+                for backend in backends:
+                    if not wait_for_backend(backend["address"], timeout=timeout):
+                        for program in programs:
+                            Supervisor.stop(name=program, remove=True)
+                        raise Exception("Site '%s' didn't answer on %s after %ss. "
+                                        "'%s' is still live" % (name, backend["address"], timeout,
+                                                                live_app_name))
+                error = self.check_web(site, [b["address"] for b in backends], boot_timeout=0)
+                if error:
+                    for program in programs:
+                        Supervisor.stop(name=program, remove=True)
+                    raise Exception("Site '%s' failed its health check: %s. "
+                                    "'%s' is still live" % (name, error, live_app_name))
+
+        # Static files are compressed now, not on each request
+        if precompress:
+            self.precompress_web(site)
+
+        # nginx creates the cache directory of the site, not its parents
+        if cache and not DRY_RUN and not os.path.isdir(NGINX_CACHE_DIRECTORY):
+            try:
+                os.makedirs(NGINX_CACHE_DIRECTORY)
+            except OSError:  # Created by a parallel deploy
+                if not os.path.isdir(NGINX_CACHE_DIRECTORY):
+                    raise
 
         logs_dir = nginx.get("logs_dir", None)
         if not logs_dir:
             logs_dir = "%s.logs" % self.directory
-            if not os.path.isdir(logs_dir):
-                os.makedirs(logs_dir)
-
-        self.deployed_info.append((name, proxy_port, gunicorn_app_name))
-
-        with open(nginx_config_file, "wb") as f:
-            context = dict(NAME=name,
-                           SERVER_NAME=nginx.get("server_name", name),
-                           DIRECTORY=directory,
-                           PROXY_PORT=proxy_port,
-                           PORT=nginx.get("port", NGINX_DEFAULT_PORT),
-                           ROOT_DIR=nginx.get("root_dir", ""),
-                           ALIASES=nginx.get("aliases", {}),
-                           FORCE_NON_WWW=nginx.get("force_non_www", True),
-                           FORCE_WWW=nginx.get("force_www", False),
-                           SERVER_DIRECTIVES=nginx.get("server_directives", ""),
-                           SSL_CERT=nginx.get("ssl_cert", ""),
-                           SSL_KEY=nginx.get("ssl_key", ""),
-                           SSL_DIRECTIVES=nginx.get("ssl_directives", ""),
-                           LOGS_DIR=logs_dir,
-                           MAINTENANCE={}
-                           )
-            content = Template(NGINX_CONFIG).render(**context)
-            f.write(content)
-
-    def deploy_web(self, undeploy=False, maintenance=False):
+            try:
+                if not DRY_RUN:
+                    os.makedirs(logs_dir)
+            except OSError:  # Already exists, or created by a parallel deploy
+                if not os.path.isdir(logs_dir):
+                    raise
+
+        self.deployed_info.append((name, ", ".join([b["address"] for b in backends]),
+                                   gunicorn_app_name, None))
+
+        context = dict(NAME=name,
+                       SERVER_NAME=nginx.get("server_name", name),
+                       DIRECTORY=directory,
+                       BACKENDS=backends,
+                       UPSTREAM_BALANCE=upstream.get("balance", ""),
+                       UPSTREAM_KEEPALIVE=upstream.get("keepalive", NGINX_UPSTREAM_KEEPALIVE),
+                       PORT=nginx.get("port", NGINX_DEFAULT_PORT),
+                       ROOT_DIR=nginx.get("root_dir", ""),
+                       ALIASES=nginx.get("aliases", {}),
+                       STATIC=static,
+                       CACHE=cache,
+                       ACCESS_LOG=access_log,
+                       FORCE_NON_WWW=nginx.get("force_non_www", True),
+                       FORCE_WWW=nginx.get("force_www", False),
+                       SERVER_DIRECTIVES=nginx.get("server_directives", ""),
+                       SSL_CERT=nginx.get("ssl_cert", ""),
+                       SSL_KEY=nginx.get("ssl_key", ""),
+                       SSL_DIRECTIVES=nginx.get("ssl_directives", ""),
+                       LOGS_DIR=logs_dir,
+                       MAINTENANCE={}
+                       )
+        content = get_template("nginx.conf").render(**context)
+        Nginx.stage(nginx_config_file, content)
+
+        # Blue/Green: switch nginx to the new port, then drain the previous process.
+        # Only the config of this site is committed, the sites published in
+        # parallel keep theirs staged. The reloads are serialized
+        if zero_downtime and not DRY_RUN:
+            try:
+                reload_services(paths=[nginx_config_file])
+            except Exception:  # Nginx still points to the live program
+                if application:
+                    for program in self.get_deployed_web_instances(gunicorn_app_name):
+                        Supervisor.stop(name=program, remove=True)
+                raise
+            if live_app_name and live_app_name != gunicorn_app_name:
+                time.sleep(zero_downtime_options.get("drain", GUNICORN_DRAIN_TIME))
+                for program in self.get_deployed_web_instances(live_app_name):
+                    Supervisor.stop(name=program, remove=True)
+
+    def deploy_web(self, undeploy=False, maintenance=False, jobs=1):
         """
         To deploy/undeploy web app/sites
+        :params jobs: Number of sites to publish concurrently.
+                      A failing site doesn't stop the others, its error is
+                      added to deployed_info
+        :returns list: The (name, error) of the sites that failed
         """
 
         # Maintenance
@@ -638,7 +3087,25 @@ class App(object):
                     raise TypeError("'name' is missing in sites config")
                 if "application" in site and not self.virtualenv.get("name"):
                     raise TypeError("'virtualenv' is missing for Python web/app")
-                self.publish_web(site=site)
+
+            def publish(site):
+                try:
+                    self.publish_web(site=site, undeploy=undeploy)
+                except Exception as ex:
+                    self.deployed_info.append((site["name"], None, None, ex))
+                    return site["name"], ex
+
+            sites = self.config["web"]
+            if jobs > 1 and len(sites) > 1:
+                pool = multiprocessing.pool.ThreadPool(min(jobs, len(sites)))
+                try:
+                    results = pool.map(publish, sites)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [publish(site) for site in sites]
+            return [r for r in results if r]
         else:
             raise TypeError("'web' is missing in propel.yml")
 
@@ -671,32 +3138,34 @@ class App(object):
         nginx_config_file = get_domain_conf_file(name)
         maintenance = {"active": False, "page": None, "allow_ips": []}
 
-        with open(nginx_config_file, "wb") as f:
-            context = dict(NAME=name,
-                           SERVER_NAME=nginx.get("server_name", name),
-                           DIRECTORY=directory,
-                           PROXY_PORT=None,
-                           PORT=nginx.get("port", NGINX_DEFAULT_PORT),
-                           ROOT_DIR=nginx.get("root_dir", ""),
-                           ALIASES=nginx.get("aliases", {}),
-                           FORCE_NON_WWW=nginx.get("force_non_www", False),
-                           FORCE_WWW=nginx.get("force_www", False),
-                           SERVER_DIRECTIVES=nginx.get("server_directives", ""),
-                           SSL_CERT=nginx.get("ssl_cert", ""),
-                           SSL_KEY=nginx.get("ssl_key", ""),
-                           SSL_DIRECTIVES=nginx.get("ssl_directives", ""),
-                           MAINTENANCE={"ACTIVE": True,
-                                        "PAGE": maintenance.get("page", None),
-                                        "ALLOW_IPS": []}
-                           )
-            content = Template(NGINX_CONFIG).render(**context)
-            f.write(content)
+        context = dict(NAME=name,
+                       SERVER_NAME=nginx.get("server_name", name),
+                       DIRECTORY=directory,
+                       BACKENDS=[],
+                       PORT=nginx.get("port", NGINX_DEFAULT_PORT),
+                       ROOT_DIR=nginx.get("root_dir", ""),
+                       ALIASES=nginx.get("aliases", {}),
+                       STATIC=self.get_static_options(site),
+                       FORCE_NON_WWW=nginx.get("force_non_www", False),
+                       FORCE_WWW=nginx.get("force_www", False),
+                       SERVER_DIRECTIVES=nginx.get("server_directives", ""),
+                       SSL_CERT=nginx.get("ssl_cert", ""),
+                       SSL_KEY=nginx.get("ssl_key", ""),
+                       SSL_DIRECTIVES=nginx.get("ssl_directives", ""),
+                       MAINTENANCE={"ACTIVE": True,
+                                    "PAGE": maintenance.get("page", None),
+                                    "ALLOW_IPS": []}
+                       )
+        content = get_template("nginx.conf").render(**context)
+        Nginx.stage(nginx_config_file, content)
 
     def run_scripts(self, name):
         """
         Run a one time script
         :params script_name: (string) The script name to run.
         """
+        if DRY_RUN:  # Scripts can't tell what they would change
+            return
         if "scripts" in self.config and name in self.config["scripts"]:
             for script in self.config["scripts"][name]:
                 if "command" not in script:
@@ -739,6 +3208,8 @@ class App(object):
                                          directory=directory)
                 remove = worker.get("remove", False)
                 exclude = worker.get("exclude", False)
+                numprocs = worker.get("numprocs", 1)
+                options = worker.get("supervisor", {})
 
                 if exclude:  # Exclude worker from re/running
                     continue
@@ -751,28 +3222,117 @@ class App(object):
                                  command=command,
                                  directory=directory,
                                  user=user,
-                                 environment=environment)
+                                 environment=environment,
+                                 numprocs=numprocs,
+                                 options=options)
+                self.deployed_workers.append(name)
 
-    def install_requirements(self, pip_options=None):
+    def install_requirements(self, pip_options=None, force=False, virtualenv=None):
+        """
+        Install requirements.txt in the virtualenv.
+        pip is skipped when requirements.txt, pip_options and the interpreter
+        are the same as the last successful install, unless force is True
+        :params virtualenv: The venv to install in. Default: the app virtualenv
+        :returns bool: True
+        :raises Exception: If pip failed, the deploy can't go on with the virtualenv
+        """
         requirements_file = self.directory + "/requirements.txt"
         if os.path.isfile(requirements_file):
-            pip = get_venv_bin(bin_program="pip",
-                               virtualenv=self.virtualenv.get("name"))
+            virtualenv = virtualenv or self.virtualenv.get("name")
+            pip = get_venv_bin(bin_program="pip", virtualenv=virtualenv)
             pip_options = pip_options or ""
-            runvenv("%s install -r %s %s" % (pip, requirements_file, pip_options),
-                    virtualenv=self.virtualenv.get("name"))
+            fingerprint = self.get_requirements_fingerprint(requirements_file, pip_options,
+                                                            virtualenv=virtualenv)
+            fingerprint_file = "%s/%s/%s" % (VIRTUALENV_DIRECTORY, virtualenv,
+                                             VIRTUALENV_REQUIREMENTS_FINGERPRINT)
+            if not force and os.path.isfile(fingerprint_file):
+                with open(fingerprint_file) as f:
+                    if f.read().strip() == fingerprint:
+                        _print("==== Requirements unchanged. Skipping pip")
+                        return True
+            if self.virtualenv.get("wheelhouse"):
+                key = self.get_requirements_fingerprint(requirements_file, virtualenv=virtualenv)
+                if not wheelhouse_complete(key):
+                    self.build_wheels(virtualenv=virtualenv)
+                no_index = not requirements_need_index(requirements_file)
+                pip_options = "%s %s" % (wheelhouse_options(key, no_index=no_index), pip_options)
+            try:
+                runvenv("%s install -r %s %s" % (pip, requirements_file, pip_options),
+                        virtualenv=virtualenv, check=True)
+            except Exception as ex:
+                raise Exception("Requirements install failed: %s" % ex)
+            with open(fingerprint_file, "w") as f:
+                f.write(fingerprint)
+        return True
+
+    def get_requirements_fingerprint(self, requirements_file, pip_options="", virtualenv=None):
+        """
+        Return a hash of the requirements file content, including the files
+        it refers to with -r/-c, the pip options and the virtualenv interpreter
+        """
+        sha = hashlib.sha1()
+        files = [requirements_file]
+        while files:
+            requirements_file = files.pop(0)
+            if not os.path.isfile(requirements_file):
+                continue
+            with open(requirements_file, "rb") as f:
+                content = f.read()
+            sha.update(content)
+            for line in content.decode("utf-8", "replace").splitlines():
+                _ = line.split()
+                if len(_) > 1 and _[0] in ("-r", "--requirement", "-c", "--constraint"):
+                    files.append(os.path.join(os.path.dirname(requirements_file), _[1]))
+        pip_options = pip_options or ""
+        sha.update(pip_options if isinstance(pip_options, bytes) else pip_options.encode("utf-8"))
+        sha.update(get_python_version(virtualenv or self.virtualenv.get("name")).encode("utf-8"))
+        return sha.hexdigest()
+
+    def build_wheels(self, virtualenv=None):
+        """
+        Pre-build the wheels of requirements.txt into the shared wheelhouse
+        :returns bool:
+        """
+        virtualenv = virtualenv or self.virtualenv.get("name")
+        requirements_file = self.directory + "/requirements.txt"
+        if os.path.isfile(requirements_file):
+            key = self.get_requirements_fingerprint(requirements_file, virtualenv=virtualenv)
+            return wheelhouse_build("-r %s" % requirements_file, key, virtualenv=virtualenv)
+        return True
 
     def setup_virtualenv(self):
 
         if self.virtualenv.get("name"):
             if self.virtualenv.get("rebuild") == True:
-                self.destroy_virtualenv()
-            if not self.has_virtualenv():
-                virtualenv_make(self.virtualenv.get("name"))
+                self.rebuild_virtualenv()
+            elif not self.has_virtualenv():
+                virtualenv_make(self.virtualenv.get("name"),
+                                wheelhouse=self.virtualenv.get("wheelhouse", False))
+
+    def rebuild_virtualenv(self):
+        """
+        Build a new generation of the virtualenv side by side, as <name>-<timestamp>,
+        and install the requirements in it. Only then <name> is switched to it
+        with an atomic symlink swap, so the running processes keep a working
+        virtualenv, even if the rebuild fails
+        """
+        name = self.virtualenv.get("name")
+        generation = "%s-%s" % (name, datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+        _print("==== Building virtualenv: %s" % generation)
+        virtualenv_make(generation, wheelhouse=self.virtualenv.get("wheelhouse", False))
+        try:
+            self.install_requirements(self.virtualenv.get("pip_options", ""),
+                                      virtualenv=generation)
+        except Exception as ex:
+            virtualenv_remove(generation)
+            raise Exception("Virtualenv rebuild failed. '%s' is unchanged. %s" % (name, ex))
+        virtualenv_swap(name, generation)
+        virtualenv_collect(name, keep=self.virtualenv.get("keep", VIRTUALENV_KEEP_GENERATIONS))
 
     def destroy_virtualenv(self):
         if self.virtualenv.get("name"):
             virtualenv_remove(self.virtualenv.get("name"))
+            virtualenv_collect(self.virtualenv.get("name"), keep=0)
 
     def has_virtualenv(self):
         if self.virtualenv.get("name"):
@@ -783,21 +3343,64 @@ class App(object):
 def print_logo():
     _print(__doc__)
 
+def print_autotune_plan(plan):
+    cpus, memory = get_host_resources()
+    _print("==== Autotune: %s cpus, %sM memory" % (cpus, (memory or 0) // 1024 ** 2))
+    for name, site in sorted(plan.items()):
+        _print("\t %-32s %s %s worker(s) x %s instance(s), %s thread(s), %sM per worker%s"
+               % (name, site["workers"], site["worker_class"], site["instances"], site["threads"],
+                  site["worker_memory"] // 1024 ** 2,
+                  " (measured)" if site["measured"] else ""))
+        if site["warning"]:
+            _print("\t %-32s WARNING: %s" % ("", site["warning"]))
+
 def cmd():
     global CWD
 
     try:
         global VIRTUALENV_DIRECTORY
         global VERBOSE
+        global DRY_RUN
 
 
 
         parser = argparse.ArgumentParser(description="%s %s" % (__title__, __version__))
         parser.add_argument("-w", "--webs", help="Deploy sites by name. ie [-w abc.com xyz.com ...]", nargs='*')
         parser.add_argument("--all-webs", help="Deploy all sites", action="store_true")
+        parser.add_argument("-j", "--jobs", help="Number of deploy steps, sites or programs to run in parallel. "
+                                                 "Default: %s" % DEPLOY_JOBS, type=int, default=DEPLOY_JOBS)
         parser.add_argument("-s", "--scripts", help="Run script by specifying name:"
                                                     " ie: [-s pre_web post_web other_one]", nargs='*')
         parser.add_argument("-k", "--workers", help="Run Workers by specifying name: ie [-k tasks othertasks]", nargs='*')
+        parser.add_argument("--timeout", help="Seconds a deploy step may run before it's stopped "
+                                              "and the deploy fails. Default: no limit",
+                            type=float, default=DEPLOY_STEP_TIMEOUT)
+        parser.add_argument("--force-requirements", help="Run pip install even if the requirements didn't change",
+                            action="store_true")
+        parser.add_argument("--build-wheels", help="Build the wheels of requirements.txt into the shared wheelhouse",
+                            action="store_true")
+        parser.add_argument("--autotune", help="Print the gunicorn workers of each site with `autotune`",
+                            action="store_true")
+        parser.add_argument("--rotate-logs", help="Write the logrotate config of the nginx logs, "
+                                                  "and rotate them now", action="store_true")
+        parser.add_argument("--dry-run", help="Print the diff of the nginx and supervisor configs "
+                                              "of a deployment, without changing anything",
+                            action="store_true")
+        parser.add_argument("--incremental", help="On git push, only run the stages the push needs. "
+                                                  "Uses $PROPEL_OLDREV, $PROPEL_NEWREV and $PROPEL_GIT_DIR",
+                            action="store_true")
+        parser.add_argument("--git-branch", help="Branch deployed on git push, with --git-init, "
+                                                 "--git-push-web and --git-push-cmd",
+                            default=GIT_DEFAULT_BRANCH)
+        parser.add_argument("--releases", help="With --git-init, --git-push-web and --git-push-cmd, "
+                                               "check out each push in $repo/releases/<commit> "
+                                               "and keep that many. [--releases 5]",
+                            type=int, default=0)
+        parser.add_argument("--git-release", help="Check out $PROPEL_NEWREV as a release of a repo "
+                                                  "and switch to it. Used by the post-receive hook")
+        parser.add_argument("--rollback", help="Switch back to the previous release, or N releases back, "
+                                               "and reload. [--rollback 2]",
+                            nargs="?", type=int, const=1)
         parser.add_argument("-r", "--reload", help="To refresh the servers", action="store_true")
         parser.add_argument("-x", "--undeploy", help="To UNDEPLOY the application", action="store_true")
         parser.add_argument("-m", "--maintenance", help="Values: on|off - To set the site on maintenance. ie [--maintenance on]")
@@ -814,6 +3417,8 @@ def cmd():
         parser.add_argument("--debug", help="To output the full error stack in", action="store_true")
         arg = parser.parse_args()
         VERBOSE = False if arg.silent else True
+        DRY_RUN = arg.dry_run
+        Supervisor.jobs = arg.jobs
 
         _print("")
         _print("-" * 80)
@@ -864,6 +3469,7 @@ def cmd():
             if maintenance == "ON":
                 _print("::: MAINTENANCE PAGE ON :::")
                 app.maintenance()
+                reload_services()
             elif maintenance == "OFF":
                 _print("::: MAINTENANCE PAGE OFF :::")
                 arg.websites = True
@@ -872,10 +3478,54 @@ def cmd():
         if arg.undeploy:
             _print("::: UNDEPLOY :::")
             app = App(CWD)
-            app.deploy_web(undeploy=True)
-            app.run_workers(undeploy=True)
+            with app.batch():
+                failed = app.deploy_web(undeploy=True)
+                app.run_workers(undeploy=True)
+            reload_services()
+            # The virtualenv is kept for the sites still running
+            if failed:
+                for name, ex in failed:
+                    _print("==== Site '%s' failed to undeploy: %s" % (name, ex))
+                raise Exception("Undeploy failed for: %s" % ", ".join([name for name, _ in failed]))
             app.run_scripts("undeploy")
-            app.destroy_virtualenv()
+            app.setup_logrotate(undeploy=True)
+            if not DRY_RUN:
+                app.destroy_virtualenv()
+
+        # Incremental: a git push only runs the stages its changes need.
+        # The sites whose config changed are deployed below
+        if arg.incremental and not arg.undeploy:
+            app = App(CWD)
+            changes = app.get_push_changes(os.environ.get("PROPEL_OLDREV"),
+                                           os.environ.get("PROPEL_NEWREV"),
+                                           os.environ.get("PROPEL_GIT_DIR"))
+            if changes["full"]:
+                _print("::: INCREMENTAL: FULL DEPLOY :::")
+            else:
+                _print("::: INCREMENTAL DEPLOY: %s file(s) changed :::" % len(changes["files"]))
+                others = [site["name"] for site in app.config.get("web", [])
+                          if site.get("name") not in changes["sites"]]
+                if changes["requirements"] and app.virtualenv.get("name") and not DRY_RUN:
+                    _print("==== Requirements changed, installing ...")
+                    app.install_requirements(app.virtualenv.get("pip_options", ""))
+                if changes["static"]:
+                    _print("==== %s static file(s) changed" % len(changes["static"]))
+                    for site in app.config.get("web", []):
+                        if site.get("name") in others:
+                            app.precompress_web(site)
+                if (changes["code"] or changes["requirements"]) and not DRY_RUN:
+                    _print("==== Code changed, reloading the Python sites gracefully ...")
+                    app.reload_webs(others)
+                    _print("==== Restarting the workers ...")
+                    app.restart_workers()
+                    failed = app.check_webs(others)
+                    if failed:
+                        raise Exception("Health check failed after the reload of: %s"
+                                        % ", ".join(["'%s' (%s)" % f for f in failed]))
+                arg.webs = sorted(changes["sites"])
+                arg.all_webs = False
+                if arg.webs:
+                    _print("==== Config changed for: %s" % ", ".join(arg.webs))
 
         if arg.restart:
             _print("==== Restarting all processes...")
@@ -889,80 +3539,147 @@ def cmd():
             _m = app.config.get("maintenance")
             if _m and _m.get("active") is True and not _m.get("allow_ips"):
                 app.maintenance(names=arg.webs, undeploy_all=True)
+                reload_services()
                 _print("::: GLOBAL MAINTENANCE :::")
                 _print("")
                 exit()
 
             # MAINTENACE Auto maintenance before doing any web deployment
-            if arg.webs or arg.all_webs:
+            # Zero downtime sites stay live while the new process boots
+            if (arg.webs or arg.all_webs) and not DRY_RUN:
                 _print("=== Setup maintenance ...")
-                app.maintenance(names=arg.webs)
+                app.maintenance(names=[n for n in arg.webs or []
+                                       if not (app.get_web_by_name(n) or {}).get("zero_downtime")])
+
+            # The deployment is a graph of steps: independent steps run
+            # concurrently, `--jobs` at a time. The supervisor programs are
+            # started when the sites, or the workers, are all published
+            graph = DeployGraph(jobs=arg.jobs, timeout=arg.timeout)
+
+            def script(name, requires=None, step="script:%s"):
+                def run_script():
+                    _print("==== Running script: '%s' ..." % name)
+                    app.run_scripts(name)
+                return graph.add(step % name, run_script, requires=requires)
 
             # Virtualenv
-            if app.virtualenv.get("name"):
-                _print("::: SETTING UP VIRTUALENV :::")
-                _print("==== Virtualenv: %s " %  app.virtualenv.get("name"))
-                app.setup_virtualenv()
+            last = None
+            if app.virtualenv.get("name") and not DRY_RUN:
+                def virtualenv():
+                    _print("==== Virtualenv: %s " % app.virtualenv.get("name"))
+                    app.setup_virtualenv()
 
-                # Disabled, need to match the path that should be set during setup
-                # if app.virtualenv.get("directory"):
-                #     VIRTUALENV_DIRECTORY = app.virtualenv.get("directory")
-                #
+                    # Disabled, need to match the path that should be set during setup
+                    # if app.virtualenv.get("directory"):
+                    #     VIRTUALENV_DIRECTORY = app.virtualenv.get("directory")
+                    #
 
-                _print("::: INSTALLING REQUIREMENTS :::")
-                pip_options = app.virtualenv.get("pip_options", "")
-                app.install_requirements(pip_options)
+                def requirements():
+                    pip_options = app.virtualenv.get("pip_options", "")
+                    app.install_requirements(pip_options, force=arg.force_requirements)
 
-            _print("==== Running script: 'before_all' ...")
-            app.run_scripts("before_all")
+                graph.add("virtualenv", virtualenv)
+                last = graph.add("requirements", requirements, requires=["virtualenv"])
 
-            # Scripts. Scripts must run before web or workers, as they may contain
-            # necessary commands
+            last = script("before_all", requires=[last])
 
-            if arg.scripts:
-                _print("::: RUN SCRIPTS :::")
+            # Scripts. Scripts must run before web or workers, as they may contain
+            # necessary commands. They run one after the other
+            if arg.scripts and not DRY_RUN:
                 for name in arg.scripts:
-                    _print("====  Scripts: %s ..." % name)
-                    app.run_scripts(name)
+                    if "scripts:%s" % name not in graph:
+                        last = script(name, requires=[last], step="scripts:%s")
+
+            ends = []
 
             # Web
             if arg.webs or arg.all_webs:
-                _print("::: DEPLOY WEBSITES :::")
-
-                _print("==== Running script: 'before_web' ...")
-                app.run_scripts("before_web")
-
-                if arg.webs:
-                    for name in arg.webs:
-                        _print("==== Deploying site: %s ... " % name)
-                        app.publish_web(name=name)
-                else:
-                    _print("==== Deploying ALL WEBS ... ")
-                    app.deploy_web()
-
-                _print("==== Running script: 'after_web' ...")
-                app.run_scripts("after_web")
-
-            # Workers
+                arg.webs = sorted(set(arg.webs), key=arg.webs.index) if arg.webs else arg.webs
+                sites = [app.get_web_by_name(name) for name in arg.webs] if arg.webs \
+                    else app.config.get("web", [])
+                for name, site in zip(arg.webs or [], sites):
+                    if not site:
+                        raise ValueError("Site '%s' doesn't exist" % name)
+                if not arg.webs and "web" not in app.config:
+                    raise TypeError("'web' is missing in propel.yml")
+                for site in sites:
+                    if "name" not in site:
+                        raise TypeError("'name' is missing in sites config")
+
+                def before_web():
+                    _print("==== Running script: 'before_web' ...")
+                    app.run_scripts("before_web")
+                    plan = app.get_autotune_plan()
+                    if plan:
+                        print_autotune_plan(plan)
+
+                def publish(site):
+                    _print("==== Deploying site: %s ... " % site["name"])
+                    if arg.webs:
+                        app.publish_web(site=site, precompress=False)
+                        return
+                    try:  # A failing site doesn't stop the others
+                        app.publish_web(site=site, precompress=False)
+                    except Exception as ex:
+                        app.deployed_info.append((site["name"], None, None, ex))
+                        _print("==== Site '%s' failed: %s" % (site["name"], ex))
+
+                def start_web():
+                    # The sites with a health check are zero downtime, they
+                    # were checked before nginx was switched to them.
+                    # The workers, deployed meanwhile, are started by their own step
+                    Supervisor.commit([name for name in Supervisor.pending()
+                                       if name.startswith("propel-web__")])
+
+                def reload_nginx():
+                    _print("==== Setup logs rotation ...")
+                    app.setup_logrotate()
+                    # Supervisor was already reloaded when the programs started
+                    _print("==== Reloading NGINX ...")
+                    reload_services(force=False)
+
+                # Static files are compressed while the sites are published, once
+                # the scripts that may write them, ie: collectstatic in before_web, have run
+                graph.add("before_web", before_web, requires=[last])
+                statics = [graph.add("static:%s" % site["name"],
+                                     lambda site=site: app.precompress_web(site),
+                                     requires=["before_web"])
+                           for site in sites if not site.get("exclude") and not site.get("remove")]
+                published = [graph.add("web:%s" % site["name"],
+                                       lambda site=site: publish(site),
+                                       requires=["before_web"])
+                             for site in sites]
+                graph.add("web:start", start_web, requires=published + statics)
+                script("after_web", requires=["web:start"])
+                ends.append(graph.add("nginx", reload_nginx, requires=["script:after_web"]))
+
+            # Workers. They don't wait for the sites
             if arg.workers:
-                _print("::: RUN WORKERS :::")
-
-                _print("==== Running script: 'before_workers' ...")
-                app.run_scripts("before_workers")
-
+                arg.workers = sorted(set(arg.workers), key=arg.workers.index)
                 for name in arg.workers:
-                    _print("==== Worker: '%s' ..." % name)
-                    app.run_workers(name)
+                    if "workers" in app.config and name not in app.config["workers"]:
+                        raise TypeError("Missing worker: %s" % name)
 
-                _print("==== Running script: 'after_workers' ...")
-                app.run_scripts("after_workers")
+                def start_workers():
+                    Supervisor.commit([name for name in Supervisor.pending()
+                                       if name.startswith("propel-worker__")])
 
-            _print("==== Running script: 'after_all' ...")
-            app.run_scripts("after_all")
+                script("before_workers", requires=[last])
+                started = [graph.add("worker:%s" % name,
+                                     lambda name=name: app.run_workers(name),
+                                     requires=["script:before_workers"])
+                           for name in arg.workers]
+                graph.add("workers:start", start_workers, requires=started)
+                ends.append(script("after_workers", requires=["workers:start"]))
 
-            if arg.webs or arg.all_webs:
-                _print("==== Reloading NGINX ...")
-                reload_server()
+            script("after_all", requires=ends or [last])
+
+            _print("::: DEPLOY: %s steps, %s at a time :::" % (len(graph.steps), graph.jobs))
+            try:
+                with app.batch():
+                    graph.run()
+            finally:
+                graph.print_summary()
 
 
         # Extra
@@ -973,26 +3690,78 @@ def cmd():
                 directory = "%s" % repo
                 _print(":: GIT INIT BARE REPO ::")
                 if git.init_bare_repo(repo):
-                    git.update_post_receive_hook(repo, False)
+                    git.update_post_receive_hook(repo, False, branch=arg.git_branch,
+                                                 releases=arg.releases)
                 _print("\n\t Git Repository: %s" % bare_repo)
                 _print("\n\t Content Directory: %s/" % directory)
                 _print("\n\t Add to git remote:")
                 _print("\t\t git remote add web ssh://user@host:%s" % bare_repo)
                 _print("\n\t To push:")
-                _print("\t\t git push web master")
+                _print("\t\t git push web %s" % arg.git_branch)
                 _print("")
 
             if arg.git_push_web:
                 repo = arg.git_push_web
-                cmd = "propel -w"
+                cmd = "propel --all-webs --incremental"
                 _print("==== Setting WEB auto deploy on git push ...")
-                git.update_post_receive_hook(repo, cmd)
+                git.update_post_receive_hook(repo, cmd, branch=arg.git_branch,
+                                             releases=arg.releases)
 
             if arg.git_push_cmd:
                 repo = arg.git_push_cmd[0]
                 cmds = "; ".join(arg.git_push_cmd[1:])
                 _print("==== Setting custom CMD on git push ...")
-                git.update_post_receive_hook(repo, cmds)
+                git.update_post_receive_hook(repo, cmds, branch=arg.git_branch,
+                                             releases=arg.releases)
+
+            if arg.git_release:
+                repo = os.path.abspath(arg.git_release)
+                rev = os.environ.get("PROPEL_NEWREV")
+                if not rev:
+                    raise Exception("$PROPEL_NEWREV is not set")
+                _print("==== Release: %s ..." % rev)
+                release = git.create_release(repo, rev, git_dir=os.environ.get("PROPEL_GIT_DIR"))
+                git.switch_release(repo, release)
+                git.collect_releases(repo, keep=arg.releases or RELEASES_KEEP)
+
+            if arg.rollback:
+                # From the repo, or its `current` release
+                repo = os.path.dirname(CWD) if os.path.basename(CWD) == RELEASES_CURRENT else CWD
+                release = git.rollback(repo, arg.rollback)
+                _print("==== Rolled back to release: %s" % os.path.basename(release))
+                app = App(os.path.join(repo, RELEASES_CURRENT))
+                app.reload_webs()
+                app.restart_workers()
+                failed = app.check_webs()
+                if failed:
+                    raise Exception("Health check failed after the rollback of: %s"
+                                    % ", ".join(["'%s' (%s)" % f for f in failed]))
+
+            if arg.build_wheels:
+                app = App(CWD)
+                _print("==== Building wheels into %s ..." % WHEELHOUSE_DIRECTORY)
+                # In a scratch virtualenv, the live one is left alone
+                scratch = "propel-wheels-%s" % os.getpid()
+                try:
+                    virtualenv_make(scratch, wheelhouse=app.virtualenv.get("wheelhouse", False))
+                    app.build_wheels(virtualenv=scratch)
+                finally:
+                    virtualenv_remove(scratch)
+
+            if arg.autotune:
+                app = App(CWD)
+                plan = app.get_autotune_plan()
+                if plan:
+                    print_autotune_plan(plan)
+                else:
+                    _print("==== Autotune is not set in %s" % DEPLOY_CONFIG_FILE)
+
+            if arg.rotate_logs:
+                app = App(CWD)
+                _print("==== Rotating logs ...")
+                conf_file = app.setup_logrotate()
+                if conf_file and not DRY_RUN:
+                    run("logrotate -f %s" % conf_file)
 
             if arg.reload:
                 _print("==== Refresh server ...")
@@ -1010,8 +3779,16 @@ def cmd():
             if (arg.webs or arg.all_webs) and app.deployed_info:
                 for i in app.deployed_info:
                     _print("- Webapp: %s" % i[0])
-                    _print("\t Gunicorn port: %s" % i[1])
+                    if i[3]:
+                        _print("\t FAILED: %s" % i[3])
+                        continue
+                    _print("\t Gunicorn bind: %s" % i[1])
                     _print("\t Supervisor process name: %s" % i[2])
+            if arg.workers and app.deployed_workers:
+                _print("- Workers:")
+                for name in app.deployed_workers:
+                    for process, state in Supervisor.statuses(name) or [(name, "UNKNOWN")]:
+                        _print("\t %-48s %s" % (process, state))
 
     except Exception as ex:
         if arg.debug:
@@ -0,0 +1,61 @@
+"""
+Render the nginx config of 1,000 sites, compiling the template for each site
+like `Template(NGINX_CONFIG)` used to, then with get_template.
+
+    python tests/bench_templates.py [sites]
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "propel"))
+sys.path.insert(0, ROOT)
+
+from jinja2 import Template
+import propel
+
+
+def site_context(i):
+    name = "site%d.example.com" % i
+    return dict(NAME=name,
+                SERVER_NAME=name,
+                DIRECTORY="/home/www/%s" % name,
+                BACKENDS=[{"address": "127.0.0.1:%d" % (8000 + i), "weight": None}],
+                UPSTREAM_BALANCE="",
+                UPSTREAM_KEEPALIVE=propel.NGINX_UPSTREAM_KEEPALIVE,
+                PORT=propel.NGINX_DEFAULT_PORT,
+                ROOT_DIR="",
+                ALIASES={"/static": "static"},
+                STATIC=dict(propel.NGINX_STATIC_DEFAULTS),
+                CACHE={},
+                ACCESS_LOG={},
+                FORCE_NON_WWW=True,
+                FORCE_WWW=False,
+                SERVER_DIRECTIVES="",
+                SSL_CERT="",
+                SSL_KEY="",
+                SSL_DIRECTIVES="",
+                LOGS_DIR="/var/log/propel/%s" % name,
+                MAINTENANCE={})
+
+
+def bench(render, contexts):
+    start = time.time()
+    for context in contexts:
+        render(context)
+    return time.time() - start
+
+
+def main(sites=1000):
+    propel.TEMPLATES_CACHE_DIRECTORY = None  # Measure the compilation, not the disk cache
+    contexts = [site_context(i) for i in range(sites)]
+    compiled = bench(lambda c: Template(propel.NGINX_CONFIG).render(**c), contexts)
+    cached = bench(lambda c: propel.get_template("nginx.conf").render(**c), contexts)
+    print("%d sites" % sites)
+    print("Template(NGINX_CONFIG): %.3fs" % compiled)
+    print("get_template:           %.3fs (%.1fx)" % (cached, compiled / cached))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
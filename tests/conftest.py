@@ -0,0 +1,23 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# propel/__init__.py imports __about__ as a top level module
+sys.path.insert(0, os.path.join(ROOT, "propel"))
+sys.path.insert(0, ROOT)
+
+import pytest
+
+import propel
+
+
+@pytest.fixture
+def make_app():
+    """
+    Build an App from a config, without reading propel.yml
+    """
+    def make(**config):
+        app = propel.App.__new__(propel.App)
+        app.config = config
+        return app
+    return make
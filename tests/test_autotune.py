@@ -0,0 +1,59 @@
+import pytest
+
+import propel
+
+MB = 1024 ** 2
+
+
+@pytest.fixture
+def autotune(monkeypatch, make_app):
+    def plan(sites, cpus=4, memory=None):
+        monkeypatch.setattr(propel, "get_host_resources", lambda: (cpus, memory))
+        monkeypatch.setattr(propel.App, "measure_worker_memory", lambda self, name: None)
+        return make_app(autotune=True, web=sites).get_autotune_plan()
+    return plan
+
+
+def site(name, **kwargs):
+    return dict(name=name, application="app:app", **kwargs)
+
+
+def test_gevent_sites_keep_their_class(autotune):
+    plan = autotune([site("a.com")])["a.com"]
+    assert plan["workers"] == 9
+    assert plan["worker_class"] == "gevent"
+    assert plan["threads"] == propel.GUNICORN_DEFAULT_THREADS
+    assert plan["warning"] is None
+
+
+def test_sync_sites_stay_sync_without_a_memory_limit(autotune):
+    plan = autotune([site("a.com", gunicorn={"worker-class": "sync"})])["a.com"]
+    assert plan["workers"] == 9
+    assert plan["worker_class"] == "sync"
+    assert plan["threads"] == 1
+
+
+def test_sync_sites_get_threads_when_memory_takes_workers_off(autotune):
+    memory = int(3 * 150 * MB / (1 - propel.AUTOTUNE_MEMORY_RESERVE)) + MB
+    plan = autotune([site("a.com", gunicorn={"worker-class": "sync"})], memory=memory)["a.com"]
+    assert plan["workers"] == 3
+    assert plan["worker_class"] == "sync"
+    assert plan["threads"] == 3
+
+
+def test_the_workers_are_shared_by_weight(autotune):
+    plan = autotune([site("a.com", weight=2), site("b.com")])
+    assert plan["a.com"]["workers"] == 6
+    assert plan["b.com"]["workers"] == 3
+
+
+def test_instances_split_the_workers(autotune):
+    plan = autotune([site("a.com", instances=2)])["a.com"]
+    assert plan["workers"] == 4
+    assert plan["instances"] == 2
+
+
+def test_each_instance_gets_a_worker_on_a_crowded_host(autotune):
+    plan = autotune([site("site%s.com" % i) for i in range(20)], cpus=8)
+    assert sorted(set([p["workers"] for p in plan.values()])) == [1]
+    assert all([p["warning"] for p in plan.values()])
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+import propel
+
+
+def test_steps_run_after_the_ones_they_require():
+    done = []
+    graph = propel.DeployGraph(jobs=4)
+    graph.add("a", lambda: (time.sleep(0.1), done.append("a")))
+    graph.add("b", lambda: done.append("b"), requires=["a"])
+    graph.add("c", lambda: done.append("c"))
+    graph.run()
+    assert done.index("a") < done.index("b")
+    assert [step.state for step in graph.steps] == ["DONE", "DONE", "DONE"]
+    assert graph.duration is not None
+
+
+def test_a_failure_cancels_the_steps_not_started():
+    def fail():
+        raise ValueError("boom")
+
+    graph = propel.DeployGraph(jobs=1)
+    graph.add("a", fail)
+    graph.add("b", lambda: None, requires=["a"])
+    with pytest.raises(Exception) as ex:
+        graph.run()
+    assert "'a' failed: boom" in str(ex.value)
+    assert [step.state for step in graph.steps] == ["FAILED", "CANCELLED"]
+    assert graph.duration is not None
+
+
+def test_a_timed_out_step_is_stopped_and_waited_for():
+    ended = threading.Event()
+
+    def slow():
+        step = propel._step_context.step
+        try:
+            step.popen(["sleep", "30"]).wait()
+        finally:
+            ended.set()
+
+    graph = propel.DeployGraph(jobs=2, timeout=0.5)
+    graph.add("slow", slow)
+    started = time.time()
+    with pytest.raises(Exception) as ex:
+        graph.run()
+    assert "timed out" in str(ex.value)
+    assert ended.is_set()
+    assert time.time() - started < 10
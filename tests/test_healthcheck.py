@@ -0,0 +1,137 @@
+"""
+Health checks against a stub HTTP server, on a port and on a unix socket
+"""
+import socket
+import threading
+import time
+
+import pytest
+
+import propel
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get("Host")))
+        status = server.statuses.pop(0) if len(server.statuses) > 1 else server.statuses[0]
+        if server.delay:
+            time.sleep(server.delay)
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def address_string(self):
+        return "stub"
+
+    def log_message(self, *args):
+        pass
+
+
+class TCPStub(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixStub(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(server, statuses, delay=0):
+    server.statuses = list(statuses)
+    server.requests = []
+    server.delay = delay
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(statuses, delay=0, unix_path=None):
+        if unix_path:
+            server = serve(UnixStub(unix_path, StubHandler), statuses, delay)
+            address = "unix:%s" % unix_path
+        else:
+            server = serve(TCPStub(("127.0.0.1", 0), StubHandler), statuses, delay)
+            address = "127.0.0.1:%s" % server.server_address[1]
+        started.append(server)
+        return server, address
+
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def options(**kwargs):
+    _options = dict(propel.HEALTHCHECK_DEFAULTS, retries=3, interval=0.05, timeout=1)
+    _options.update(kwargs)
+    return _options
+
+
+def test_probe_sends_the_path_and_host(servers):
+    server, address = servers([200])
+    assert propel.probe_backend(address, path="/health", host="a.com") == 200
+    assert server.requests == [("/health", "a.com")]
+
+
+def test_probe_over_a_unix_socket(servers, tmpdir):
+    server, address = servers([204], unix_path=str(tmpdir.join("web.sock")))
+    assert propel.check_backend(address, options(status=[200, 204])) == (True, None)
+
+
+def test_retries_until_the_expected_status(servers):
+    server, address = servers([503, 503, 200])
+    assert propel.check_backend(address, options()) == (True, None)
+    assert len(server.requests) == 3
+
+
+def test_wrong_status_fails_after_the_retries(servers):
+    server, address = servers([500])
+    ok, error = propel.check_backend(address, options())
+    assert not ok and "HTTP 500" in error
+    assert len(server.requests) == 3
+
+
+def test_slow_response_times_out(servers):
+    server, address = servers([200], delay=1)
+    ok, error = propel.check_backend(address, options(retries=1, timeout=0.2))
+    assert not ok and error
+
+
+def test_no_listener_fails(servers):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    address = "127.0.0.1:%s" % port
+    assert propel.check_backend(address, options(), boot_timeout=0.5) == \
+        (False, "no connection after 0.5s")
+    assert propel.check_backend(address, options())[0] is False
+
+
+def test_backends_are_checked_concurrently(servers):
+    _, good = servers([200])
+    _, bad = servers([500])
+    failures = propel.check_backends([good, bad], options(retries=1))
+    assert [address for address, _ in failures] == [bad]
+
+
+def test_healthcheck_requires_zero_downtime():
+    app = propel.App.__new__(propel.App)
+    site = {"name": "a.com", "application": "app:app", "healthcheck": "/health"}
+    with pytest.raises(ValueError):
+        app.get_healthcheck_options(site)
+    site["zero_downtime"] = True
+    assert app.get_healthcheck_options(site)["path"] == "/health"
@@ -0,0 +1,105 @@
+"""
+Nginx staging and commit, against a stub nginx binary: `nginx -t` fails
+when an included site config contains `invalid`
+"""
+import os
+import stat
+import sys
+
+import pytest
+
+import propel
+
+STUB_NGINX = """#!%(python)s
+import glob, os, re, sys
+args = sys.argv[1:]
+conf = args[args.index("-c") + 1] if "-c" in args else %(main_conf)r
+with open(conf) as f:
+    text = f.read()
+for pattern in re.findall(r"include\\s+([^;]+);", text):
+    if not os.path.isabs(pattern):
+        pattern = os.path.join(os.path.dirname(conf), pattern)
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            if "invalid" in f.read():
+                print("nginx: [emerg] unknown directive in %%s:1" %% path)
+                sys.exit(1)
+print("nginx: the configuration file %%s syntax is ok" %% conf)
+"""
+
+
+@pytest.fixture
+def nginx(tmpdir, monkeypatch):
+    conf_dir = tmpdir.mkdir("nginx")
+    sites_dir = conf_dir.mkdir("sites-enabled")
+    conf_dir.join("mime.types").write("types {}\n")
+    main_conf = conf_dir.join("nginx.conf")
+    main_conf.write("http {\n    include mime.types;\n    include %s/*;\n}\n" % sites_dir)
+    binary = tmpdir.join("nginx-stub")
+    binary.write(STUB_NGINX % {"python": sys.executable, "main_conf": str(main_conf)})
+    os.chmod(str(binary), os.stat(str(binary)).st_mode | stat.S_IEXEC)
+
+    dist_config = propel.get_dist_config
+    monkeypatch.setattr(propel, "NGINX_BIN", str(binary))
+    monkeypatch.setattr(propel, "NGINX_MAIN_CONF", str(main_conf))
+    monkeypatch.setattr(propel, "get_dist_config", lambda key: str(sites_dir.join("%s.conf"))
+                        if key == "NGINX_CONF_FILE" else dist_config(key))
+    monkeypatch.setattr(propel.Nginx, "_staged", {})
+    return sites_dir
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_valid_configs_are_promoted(nginx):
+    path = propel.get_domain_conf_file("a.com")
+    propel.Nginx.stage(path, "server { a }")
+    assert not os.path.exists(path)
+    assert propel.Nginx.commit() is True
+    assert read(path) == "server { a }"
+
+
+def test_an_invalid_config_only_drops_its_site(nginx):
+    good = propel.get_domain_conf_file("good.com")
+    bad = propel.get_domain_conf_file("bad.com")
+    with open(bad, "w") as f:
+        f.write("server { live }")
+    propel.Nginx.stage(good, "server { good }")
+    propel.Nginx.stage(bad, "server { invalid }")
+    with pytest.raises(Exception) as ex:
+        propel.Nginx.commit()
+    assert "bad.com" in str(ex.value)
+    assert read(good) == "server { good }"
+    assert read(bad) == "server { live }"
+    assert propel.Nginx._staged == {}
+
+
+def test_commit_of_a_site_leaves_the_others_staged(nginx):
+    a = propel.get_domain_conf_file("a.com")
+    b = propel.get_domain_conf_file("b.com")
+    propel.Nginx.stage(a, "server { a }")
+    propel.Nginx.stage(b, "server { invalid }")
+    assert propel.Nginx.commit([a]) is True
+    assert read(a) == "server { a }"
+    assert list(propel.Nginx._staged) == [b]
+
+
+def test_removal_is_staged(nginx):
+    path = propel.get_domain_conf_file("a.com")
+    with open(path, "w") as f:
+        f.write("server { a }")
+    propel.Nginx.remove(path)
+    assert os.path.exists(path)
+    propel.Nginx.commit()
+    assert not os.path.exists(path)
+
+
+def test_write_config_leaves_no_file_in_the_included_directory(nginx):
+    path = propel.get_domain_conf_file("a.com")
+    assert propel.write_config(path, "server { a }") is True
+    assert propel.write_config(path, "server { a }") is False
+    assert os.listdir(str(nginx)) == ["a.com.conf"]
+    assert [f for f in os.listdir(os.path.dirname(str(nginx))) if f.startswith(".propel-")] == []
+    assert read(path) == "server { a }"
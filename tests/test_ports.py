@@ -0,0 +1,47 @@
+import socket
+
+import pytest
+
+import propel
+
+
+@pytest.fixture
+def registry(tmpdir, monkeypatch):
+    monkeypatch.setattr(propel.Supervisor, "status", classmethod(lambda cls, name: None))
+    return propel.PortRegistry(str(tmpdir.join("ports.json")), port_range=[20000, 20100])
+
+
+def test_a_program_keeps_its_port(registry):
+    port = registry.allocate("propel-web__a")
+    assert registry.allocate("propel-web__a") == port
+    assert registry.allocate("propel-web__b") != port
+
+
+def test_released_ports_are_reused(registry):
+    port = registry.allocate("propel-web__a")
+    registry.release("propel-web__a")
+    assert registry.get("propel-web__a") is None
+    assert registry.allocate("propel-web__b") == port
+
+
+def test_a_port_taken_by_another_process_is_replaced(registry):
+    port = registry.allocate("propel-web__a")
+    squatter = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    squatter.bind(("0.0.0.0", port))
+    squatter.listen(1)
+    try:
+        assert registry.allocate("propel-web__a") != port
+    finally:
+        squatter.close()
+
+
+def test_a_running_program_keeps_its_bound_port(registry, monkeypatch):
+    port = registry.allocate("propel-web__a")
+    monkeypatch.setattr(propel.Supervisor, "status", classmethod(lambda cls, name: "RUNNING"))
+    gunicorn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    gunicorn.bind(("0.0.0.0", port))
+    gunicorn.listen(1)
+    try:
+        assert registry.allocate("propel-web__a") == port
+    finally:
+        gunicorn.close()
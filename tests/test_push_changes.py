@@ -0,0 +1,72 @@
+import os
+import subprocess
+
+import pytest
+
+
+@pytest.fixture
+def repo(tmpdir):
+    path = str(tmpdir)
+
+    def git(*args):
+        return subprocess.check_output(("git", "-c", "user.name=t", "-c", "user.email=t@t")
+                                       + args, cwd=path).decode("utf-8").strip()
+
+    def commit(*files):
+        for f in files:
+            f = os.path.join(path, f)
+            if not os.path.isdir(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+            with open(f, "a") as fp:
+                fp.write("x\n")
+        git("add", "-A")
+        git("commit", "-q", "-m", "push")
+        return git("rev-parse", "HEAD")
+
+    git("init", "-q")
+    commit("README")
+    return path, commit
+
+
+def test_files_under_an_alias_are_static(repo, make_app):
+    path, commit = repo
+    app = make_app(web=[{"name": "a.com", "application": "app:app",
+                         "nginx": {"aliases": {"/static": "static"}}}])
+    old = commit("app.py")
+    new = commit("static/app.js", "templates/page.html")
+    changes = app.get_push_changes(old, new, os.path.join(path, ".git"))
+    assert changes["static"] == ["static/app.js"]
+    assert changes["code"] is True
+
+
+def test_files_of_a_site_without_application_are_static(repo, make_app):
+    path, commit = repo
+    app = make_app(web=[{"name": "a.com", "application": "app:app"},
+                        {"name": "b.com", "nginx": {"root_dir": "php"}}])
+    old = commit("app.py")
+    new = commit("php/index.php")
+    changes = app.get_push_changes(old, new, os.path.join(path, ".git"))
+    assert changes["static"] == ["php/index.php"]
+    assert changes["code"] is False
+
+
+def test_a_site_at_the_root_does_not_make_the_code_static(repo, make_app):
+    path, commit = repo
+    app = make_app(web=[{"name": "a.com", "application": "app:app",
+                         "nginx": {"aliases": {"/static": "static"}}},
+                        {"name": "b.com"}])
+    old = commit("app.py")
+    new = commit("app.py", "static/app.js")
+    changes = app.get_push_changes(old, new, os.path.join(path, ".git"))
+    assert changes["static"] == ["static/app.js"]
+    assert changes["code"] is True
+
+
+def test_everything_is_static_without_python_sites(repo, make_app):
+    path, commit = repo
+    app = make_app(web=[{"name": "b.com", "nginx": {"root_dir": "."}}])
+    old = commit("index.html")
+    new = commit("index.html", "css/site.css")
+    changes = app.get_push_changes(old, new, os.path.join(path, ".git"))
+    assert changes["static"] == ["css/site.css", "index.html"]
+    assert changes["code"] is False
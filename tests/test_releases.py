@@ -0,0 +1,38 @@
+import os
+import subprocess
+
+import propel
+
+
+def commit(path, name):
+    git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+    with open(os.path.join(path, name), "w") as f:
+        f.write(name)
+    subprocess.check_call(git + ["add", "-A"], cwd=path)
+    subprocess.check_call(git + ["commit", "-q", "-m", name], cwd=path)
+    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path).decode("utf-8").strip()
+
+
+def test_releases_keep_the_order_they_were_created_in(tmpdir):
+    source = str(tmpdir.mkdir("source"))
+    subprocess.check_call(["git", "init", "-q"], cwd=source)
+    repo = str(tmpdir.mkdir("www"))
+    git = propel.Git(repo)
+    revs = [commit(source, name) for name in ("a", "b", "c")]
+    releases = [git.create_release(repo, rev, git_dir=os.path.join(source, ".git"))
+                for rev in revs]
+    git.switch_release(repo, releases[-1])
+    assert git.get_releases(repo) == releases[::-1]
+
+    # ie: a .pyc written in the oldest release bumps its mtime
+    with open(os.path.join(releases[0], "app.pyc"), "w") as f:
+        f.write("")
+    os.utime(releases[0], (2 ** 31 - 1, 2 ** 31 - 1))
+    assert git.get_releases(repo) == releases[::-1]
+    assert git.rollback(repo) == releases[1]
+    assert git.collect_releases(repo, keep=1) == [releases[0]]
+    assert git.get_releases(repo) == releases[:0:-1]
+
+    # Pushing a release again makes it the newest
+    git.create_release(repo, revs[1], git_dir=os.path.join(source, ".git"))
+    assert git.get_releases(repo) == [releases[1], releases[2]]
@@ -0,0 +1,24 @@
+import propel
+
+
+def fingerprint(app, directory, pip_options=""):
+    return app.get_requirements_fingerprint(str(directory.join("requirements.txt")),
+                                            pip_options=pip_options, virtualenv="venv")
+
+
+def test_requirements_fingerprint(tmpdir, monkeypatch, make_app):
+    monkeypatch.setattr(propel, "get_python_version", lambda virtualenv=None: "3.8.0")
+    app = make_app()
+    tmpdir.join("requirements.txt").write("flask==1.0\n-r base.txt\n")
+    tmpdir.join("base.txt").write("six==1.0\n")
+    first = fingerprint(app, tmpdir)
+    assert fingerprint(app, tmpdir) == first
+
+    tmpdir.join("base.txt").write("six==1.1\n")
+    included = fingerprint(app, tmpdir)
+    assert included != first
+
+    assert fingerprint(app, tmpdir, pip_options="--pre") != included
+
+    tmpdir.join("requirements.txt").write("flask==1.1\n-r base.txt\n")
+    assert fingerprint(app, tmpdir) != included
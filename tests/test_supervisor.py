@@ -0,0 +1,237 @@
+"""
+Supervisor against a fake supervisord, serving XML-RPC on a unix socket
+"""
+import os
+import socket
+import threading
+
+import pytest
+
+import propel
+
+try:
+    from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:  # Python 3
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+class KeepAliveHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = False  # TCP only
+
+    def log_message(self, *args):
+        pass
+
+
+class UnixXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def __init__(self, path):
+        SimpleXMLRPCServer.__init__(self, path, requestHandler=KeepAliveHandler,
+                                    logRequests=False, allow_none=True)
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ("localhost", 0)
+
+
+class FakeSupervisord(object):
+    """
+    The supervisor namespace of supervisord, with the programs in memory.
+    `config` is what the conf files say, `groups` what is loaded
+    """
+    def __init__(self):
+        self.calls = []
+        self.config = set()
+        self.conf_dir = None  # When set, `config` is read from its conf files
+        self.groups = {}  # group: statename
+
+    def _info(self, group):
+        return {"group": group, "name": group, "statename": self.groups[group],
+                "pid": 100 if self.groups[group] == "RUNNING" else 0,
+                "description": ""}
+
+    def register(self, server):
+        for name in ["getState", "getProcessInfo", "getAllProcessInfo", "reloadConfig",
+                     "addProcessGroup", "removeProcessGroup", "stopProcessGroup",
+                     "startProcess", "stopProcess"]:
+            server.register_function(self._recorded(name), "supervisor.%s" % name)
+
+    def _recorded(self, name):
+        method = getattr(self, name)
+
+        def call(*args):
+            self.calls.append((name,) + args)
+            return method(*args)
+        return call
+
+    def getState(self):
+        return {"statecode": 1, "statename": "RUNNING"}
+
+    def getProcessInfo(self, name):
+        group, _, process = name.partition(":")
+        if group not in self.groups or (process and process != group):
+            raise propel.xmlrpclib.Fault(10, "BAD_NAME: %s" % name)
+        return self._info(group)
+
+    def getAllProcessInfo(self):
+        return [self._info(group) for group in sorted(self.groups)]
+
+    def reloadConfig(self):
+        if self.conf_dir:
+            self.config = set([f[:-5] for f in os.listdir(self.conf_dir) if f.endswith(".conf")])
+        added = sorted(self.config - set(self.groups))
+        removed = sorted(set(self.groups) - self.config)
+        return [[added, [], removed]]
+
+    def addProcessGroup(self, group):
+        self.groups[group] = "STOPPED"
+        return True
+
+    def removeProcessGroup(self, group):
+        self.groups.pop(group, None)
+        return True
+
+    def stopProcessGroup(self, group):
+        self.groups[group] = "STOPPED"
+        return True
+
+    def startProcess(self, name):
+        self.groups[name.split(":")[0]] = "RUNNING"
+        return True
+
+    def stopProcess(self, name):
+        self.groups[name.split(":")[0]] = "STOPPED"
+        return True
+
+
+@pytest.fixture
+def supervisord(tmpdir, monkeypatch):
+    path = str(tmpdir.join("supervisor.sock"))
+    server = UnixXMLRPCServer(path)
+    fake = FakeSupervisord()
+    fake.register(server)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(propel, "SUPERVISOR_SOCKETS", [path])
+    monkeypatch.setattr(propel.Supervisor, "_rpc_socket", None)
+    monkeypatch.setattr(propel.Supervisor, "_local", threading.local())
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+def names(calls):
+    return [call[0] for call in calls]
+
+
+def test_rpc_is_used(supervisord):
+    assert propel.Supervisor.rpc() is not None
+    propel.Supervisor.ctl("start", "propel-web__a:*")
+    assert ("startProcess", "propel-web__a:*") in supervisord.calls
+
+
+def test_reread_only_compares(supervisord):
+    supervisord.config = set(["propel-web__a"])
+    propel.Supervisor.ctl("reread", "")
+    assert names(supervisord.calls)[-1] == "reloadConfig"
+    assert supervisord.groups == {}
+
+
+def test_update_applies_the_changes(supervisord):
+    supervisord.groups = {"propel-web__old": "RUNNING"}
+    supervisord.config = set(["propel-web__a", "propel-web__b"])
+    propel.Supervisor.ctl("update", "")
+    assert sorted(supervisord.groups) == ["propel-web__a", "propel-web__b"]
+    assert "stopProcessGroup" in names(supervisord.calls)
+
+
+def test_update_of_a_program_leaves_the_others_pending(supervisord):
+    supervisord.groups = {"propel-web__old": "RUNNING"}
+    supervisord.config = set(["propel-web__a", "propel-web__b"])
+    propel.Supervisor.ctl("update", "propel-web__a")
+    assert sorted(supervisord.groups) == ["propel-web__a", "propel-web__old"]
+    propel.Supervisor.reload(groups=["propel-web__b", "propel-web__old"])
+    assert sorted(supervisord.groups) == ["propel-web__a", "propel-web__b"]
+
+
+@pytest.fixture
+def conf_dir(tmpdir, monkeypatch, supervisord):
+    path = tmpdir.mkdir("conf.d")
+    monkeypatch.setattr(propel, "SUPERVISOR_CONF_DIR", str(path))
+    monkeypatch.setattr(propel, "SUPERVISOR_LOG_DIR", str(tmpdir))
+    supervisord.conf_dir = str(path)
+    return path
+
+
+def test_batch_starts_the_programs_on_exit(supervisord, conf_dir):
+    with propel.Supervisor.batch():
+        propel.Supervisor.start("propel-web__a", "true")
+        propel.Supervisor.start("propel-worker__b", "true")
+        assert supervisord.groups == {}
+    assert supervisord.groups == {"propel-web__a": "RUNNING", "propel-worker__b": "RUNNING"}
+
+
+def test_commit_of_some_programs_leaves_the_others_pending(supervisord, conf_dir):
+    with propel.Supervisor.batch():
+        propel.Supervisor.start("propel-web__a", "true")
+        propel.Supervisor.start("propel-worker__b", "true")
+        propel.Supervisor.commit(["propel-web__a"])
+        assert supervisord.groups == {"propel-web__a": "RUNNING"}
+        assert propel.Supervisor.pending() == ["propel-worker__b"]
+    assert supervisord.groups["propel-worker__b"] == "RUNNING"
+
+
+def test_status_of_a_program_is_looked_up_alone(supervisord):
+    supervisord.groups = {"propel-web__a": "RUNNING", "propel-web__b": "STOPPED"}
+    assert propel.Supervisor.status("propel-web__a") == "RUNNING"
+    assert propel.Supervisor.status("propel-web__b") == "STOPPED"
+    assert "getAllProcessInfo" not in names(supervisord.calls)
+    assert propel.Supervisor.status("propel-web__unknown") is None
+
+
+def test_numprocs_must_be_at_least_1():
+    assert propel.Supervisor.get_options({"numprocs": 2})["numprocs"] == 2
+    with pytest.raises(ValueError):
+        propel.Supervisor.get_options({"numprocs": 0})
+    with pytest.raises(ValueError):
+        propel.Supervisor.start("propel-worker__w", "true", numprocs=0)
+
+
+def test_stderr_log_only_without_redirect(supervisord, conf_dir):
+    propel.Supervisor.start("propel-worker__a", "true")
+    propel.Supervisor.start("propel-worker__b", "true", options={"redirect_stderr": False})
+    with open(os.path.join(conf_dir, "propel-worker__a.conf")) as f:
+        a = f.read()
+    with open(os.path.join(conf_dir, "propel-worker__b.conf")) as f:
+        b = f.read()
+    assert "redirect_stderr=true" in a and "stderr_logfile" not in a
+    assert "stderr_logfile=" in b
+    assert "maxbytes" not in a + b
+
+
+def test_removed_programs_are_pending(supervisord, conf_dir):
+    with propel.Supervisor.batch():
+        propel.Supervisor.start("propel-web__a", "true")
+        propel.Supervisor.start("propel-worker__b", "true")
+        propel.Supervisor.stop("propel-web__a", remove=True)
+        assert propel.Supervisor.pending() == ["propel-worker__b", "propel-web__a"]
+
+
+def test_a_running_program_is_only_stopped_when_committed(supervisord, conf_dir):
+    propel.Supervisor.start("propel-web__a", "true")
+    assert supervisord.groups == {"propel-web__a": "RUNNING"}
+    with propel.Supervisor.batch():
+        propel.Supervisor.start("propel-web__a", "true")
+        assert supervisord.groups == {"propel-web__a": "RUNNING"}
+        del supervisord.calls[:]
+    assert [call[0] for call in supervisord.calls if call[0] != "getProcessInfo"] == \
+        ["stopProcess", "startProcess"]
+    assert supervisord.groups == {"propel-web__a": "RUNNING"}
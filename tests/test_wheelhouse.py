@@ -0,0 +1,72 @@
+"""
+The wheelhouse, offline: pip only looks in a local --find-links directory
+"""
+import os
+import stat
+import sys
+import zipfile
+
+import pytest
+
+import propel
+
+WHEEL = "propel_dummy-1.0-py2.py3-none-any.whl"
+
+
+def make_wheel(directory):
+    files = {
+        "propel_dummy.py": "",
+        "propel_dummy-1.0.dist-info/METADATA": "Metadata-Version: 2.1\nName: propel-dummy\n"
+                                               "Version: 1.0\n",
+        "propel_dummy-1.0.dist-info/WHEEL": "Wheel-Version: 1.0\nGenerator: test\n"
+                                            "Root-Is-Purelib: true\nTag: py2-none-any\n"
+                                            "Tag: py3-none-any\n",
+    }
+    record = "".join(["%s,,\n" % name for name in files]) + "propel_dummy-1.0.dist-info/RECORD,,\n"
+    files["propel_dummy-1.0.dist-info/RECORD"] = record
+    with zipfile.ZipFile(os.path.join(directory, WHEEL), "w") as wheel:
+        for name, content in files.items():
+            wheel.writestr(name, content)
+
+
+@pytest.fixture
+def wheelhouse(tmpdir, monkeypatch):
+    links = tmpdir.mkdir("links")
+    make_wheel(str(links))
+    bin_dir = tmpdir.mkdir("venvs").mkdir("venv").mkdir("bin")
+    pip = bin_dir.join("pip")
+    pip.write("#!/bin/sh\nexec %s -m pip \"$@\"\n" % sys.executable)
+    os.chmod(str(pip), os.stat(str(pip)).st_mode | stat.S_IEXEC)
+    os.symlink(sys.executable, str(bin_dir.join("python")))
+
+    monkeypatch.setattr(propel, "VIRTUALENV_DIRECTORY", str(tmpdir.join("venvs")))
+    monkeypatch.setattr(propel, "WHEELHOUSE_DIRECTORY", str(tmpdir.join("wheelhouse")))
+    monkeypatch.setattr(propel, "_venv_environs", {})
+    monkeypatch.setenv("PIP_NO_INDEX", "1")
+    monkeypatch.setenv("PIP_FIND_LINKS", str(links))
+    monkeypatch.setenv("PIP_DISABLE_PIP_VERSION_CHECK", "1")
+    return tmpdir.join("wheelhouse")
+
+
+def test_wheels_are_built_then_installed_offline(wheelhouse):
+    assert propel.wheelhouse_build("propel-dummy", "key", virtualenv="venv") is True
+    assert WHEEL in os.listdir(str(wheelhouse))
+    assert propel.wheelhouse_complete("key")
+    assert propel.wheelhouse_options("key").startswith("--no-index --find-links")
+    assert propel.wheelhouse_options("key", no_index=False).startswith("--find-links")
+
+
+def test_virtualenv_default_packages_from_the_wheelhouse(wheelhouse, monkeypatch):
+    commands = []
+    runvenv = propel.runvenv
+
+    def fake_runvenv(command, virtualenv=None, check=False):
+        commands.append(command)
+        if " wheel " in command:  # Builds into the wheelhouse, the rest is not run
+            return runvenv(command, virtualenv=virtualenv, check=check)
+
+    monkeypatch.setattr(propel, "runvenv", fake_runvenv)
+    monkeypatch.setattr(propel, "VIRTUALENV_DEFAULT_PACKAGES", ["propel-dummy"])
+    propel.virtualenv_make("venv", wheelhouse=True)
+    assert WHEEL in os.listdir(str(wheelhouse))
+    assert "--no-index --find-links %s" % wheelhouse in commands[-1]